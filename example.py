@@ -1,12 +1,8 @@
 # Example workflow running sparque with Midnight Scan Club dataset
-from sparque import utils
-from sparque import parcellation_dict
-from sparque import func_conn
-from sparque import cluster
-from sparque import sparque
-
 import glob
 
+from sparque import cluster, func_conn, parcellation_dict, sparque, utils
+
 # Keep this since parcellation_dict assumes the existence of these parcellations
 parcellations = ['schaefer2018', 'gordon2016', 'glasser2016']
 
@@ -41,19 +37,23 @@ func_conn.subset_confounds(confounds, ['trans_x', 'trans_y', 'trans_z', 'rot_x',
 
 subsetted_confounds = glob.glob(f'subset_confounds/*.tsv', recursive=True)
 
-for _, curr_parc in enumerate(parcellations):
-    conn_df = func_conn.conn_from_dir(curr_parc, parcellation_df['parc_file'][parcellation_df['parcellation'] == curr_parc].iloc[0], scans, subsetted_confounds, f'{curr_parc}_func_conn.csv')
+# each scan is read once for all parcellations
+parc_files = [parcellation_df['parc_file'][parcellation_df['parcellation'] == curr_parc]
+              .iloc[0] for curr_parc in parcellations]
+output_names = [f'{curr_parc}_func_conn' for curr_parc in parcellations]
+all_conn_df = func_conn.conn_from_dir_many(parcellations, parc_files, scans,
+                                           subsetted_confounds, output_names)
 
 # Example code if want to change label to something other than subject
-# schaefer_fc = pd.read_csv('schaefer2018_func_conn.csv')
+# schaefer_fc = conn_store.conn_store_to_df('schaefer2018_func_conn')
 # schaefer_fc['label'] = ...
-# schaefer_fc.to_csv('schaefer2018_func_conn.csv', ignore_index = True)
+# conn_store.conn_df_to_store(schaefer_fc, 'schaefer2018_func_conn')
 
 # Add functional connectivity file to dictionary
 # Note: this works even if you didn't run functional connectivity for all the parcellations
 connectivity_files = []
 for _, curr_parc in enumerate(parcellations):
-    connectivity_files.append(f'{curr_parc}_func_conn.csv')
+    connectivity_files.append(f'{curr_parc}_func_conn')
 
 parcellation_df['func_conn_file'] = connectivity_files
 
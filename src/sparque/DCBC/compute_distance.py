@@ -20,10 +20,15 @@ OUTPUT:     The expected distance matrix using given algorithm
 
 Author: Da Zhi
 '''
-import numpy as np
+import warnings
+
 import nibabel as nb
+import numpy as np
+import scipy.io as spio
 from scipy import sparse
-import warnings
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
 
@@ -51,27 +56,130 @@ def euclidean_distance(a, b, decimals=3):
     return dist
 
 
+def euclidean_distance_sparse(vertices, max_dist, decimals=3):
+    """
+    Compute the euclidean distance between all pairs of vertices that are
+    within max_dist of each other, using a KD-tree radius query so that
+    no dense [N * N] matrix is built.
+
+        :param vertices: ndarray, shape: (n_vertices, 3) vertex coordinates
+        :param max_dist: the maximum distance of the returned pairs
+        :param decimals: the number of decimals distances are rounded to
+
+        :return:  dist - sparse CSR distance matrix [N * N], pairs further
+                  than max_dist (and each vertex with itself) are not stored
+    """
+    tree = cKDTree(vertices)
+    # distances are thresholded after rounding, so query slightly past max_dist
+    dist = tree.sparse_distance_matrix(tree, max_dist + 0.5 * 10 ** -decimals,
+                                       output_type='coo_matrix')
+    dist.data = np.round(dist.data, decimals)
+    dist.data[dist.data > max_dist] = 0
+
+    dist = dist.tocsr()
+    dist.eliminate_zeros()
+    return dist
+
+
+def surface_edges(vertices, faces):
+    """
+    Build the undirected graph of the edges of a triangulated surface mesh,
+    weighted by the euclidean length of each edge.
+
+        :param vertices: ndarray, shape: (n_vertices, 3) vertex coordinates
+        :param faces: ndarray, shape: (n_faces, 3) vertex indices of each triangle
+
+        :return:  graph - sparse CSR matrix [N * N] of edge lengths, each edge
+                  stored once (use it as an undirected graph)
+    """
+    faces = np.asarray(faces, dtype=np.int64)
+    # each edge is shared by two triangles, keep a single copy of it
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    length = np.sqrt(np.sum(np.square(vertices[edges[:, 0]] - vertices[edges[:, 1]]),
+                            axis=1))
+
+    graph = sparse.coo_matrix((length, (edges[:, 0], edges[:, 1])),
+                              shape=(vertices.shape[0], vertices.shape[0])).tocsr()
+    return graph
+
+
+def geodesic_distance_sparse(vertices, faces, max_dist, decimals=3, chunk_size=500):
+    """
+    Compute the geodesic (Dijkstra's shortest path along the mesh edges)
+    distance between all pairs of vertices that are within max_dist of each
+    other. The search from each vertex stops at max_dist, and sources are
+    processed in chunks so that memory stays bounded by chunk_size * N.
+
+        :param vertices: ndarray, shape: (n_vertices, 3) vertex coordinates
+        :param faces: ndarray, shape: (n_faces, 3) vertex indices of each triangle
+        :param max_dist: the maximum distance of the returned pairs
+        :param decimals: the number of decimals distances are rounded to
+        :param chunk_size: the number of source vertices searched at once
+
+        :return:  dist - sparse CSR distance matrix [N * N], pairs further
+                  than max_dist (and each vertex with itself) are not stored
+    """
+    graph = surface_edges(vertices, faces)
+    n_vertices = vertices.shape[0]
+
+    rows, cols, data = [], [], []
+    for start in range(0, n_vertices, chunk_size):
+        sources = np.arange(start, min(start + chunk_size, n_vertices))
+        chunk_dist = csgraph.dijkstra(graph, directed=False, indices=sources,
+                                      limit=max_dist)
+
+        chunk_row, col = np.nonzero(np.isfinite(chunk_dist) & (chunk_dist > 0))
+        rows.append(sources[chunk_row])
+        cols.append(col)
+        data.append(np.round(chunk_dist[chunk_row, col], decimals))
+
+    dist = sparse.csr_matrix((np.concatenate(data),
+                              (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(n_vertices, n_vertices))
+    dist.eliminate_zeros()
+    return dist
+
+
+def save_dist(dist, file_name):
+    """
+    Save a sparse distance matrix as a .mat file in the format read by
+    eval_DCBC.DCBC (variable 'avrgDs')
+    """
+    spio.savemat(file_name, {'avrgDs': sparse.csc_matrix(dist)})
+
+
 def compute_dist(files, type, max_dist=50, hems='L', dense=True):
-    dist = []
+    """
+    Compute the distance between the vertex pairs of a surface that are
+    within max_dist of each other.
+
+        :param files: the surface geometry file, default to the fs_LR 32k sphere
+        :param type: 'euclidean' - straight-line distance (KD-tree radius query)
+                     'dijkstra' - geodesic distance along the mesh edges
+        :param max_dist: the maximum distance of the returned pairs
+        :param hems: the hemisphere of the default surface file
+        :param dense: if True, return the sparse CSR matrix, otherwise a dense array
+
+        :return: the distance matrix [N * N], 0 for pairs further than max_dist
+    """
     if files is None:
         file_name = 'parcellations/fs_LR_32k template/fs_LR.32k.%s.sphere.surf.gii' % hems
     else:
         file_name = files
 
-    if type is 'euclidean':
-        mat = nb.load(file_name)
-        surf = [x.data for x in mat.darrays]
-        surf_vertices = surf[0]
+    mat = nb.load(file_name)
+    surf = [x.data for x in mat.darrays]
+    surf_vertices = surf[0].astype(np.float64)
 
-        dist = euclidean_distance(surf_vertices, surf_vertices)
-        dist[dist > max_dist] = 0
+    if type == 'euclidean':
+        dist = euclidean_distance_sparse(surf_vertices, max_dist)
 
-    elif type is 'dijstra':
-        mat = nb.load(file_name)
-        surf = [x.data for x in mat.darrays]
-        surf_vertices = surf[0]
+    elif type in ('dijkstra', 'dijstra'):
+        surf_faces = surf[1]
+        dist = geodesic_distance_sparse(surf_vertices, surf_faces, max_dist)
 
-        #TODO: call the calculation for dijstra's algorithm
-
-    return sparse.csr_matrix(dist) if dense else dist
+    else:
+        raise TypeError("Distance type cannot be recognized!")
 
+    return dist if dense else dist.toarray()
@@ -23,8 +23,8 @@ OUTPUT:     The expected similarity (dense) matrix using given algorithm
 
 Author: Da Zhi
 '''
-import numpy as np
 import nibabel as nb
+import numpy as np
 from scipy import sparse
 
 
@@ -45,53 +45,115 @@ def cosine(a, b=None):
     if b is None:
         b = a
 
-    a_norms = np.einsum('ij,ij->i', a, a)
-    b_norms = np.einsum('ij,ij->i', b, b)
-    r = np.dot(a_norms, b_norms.T)
+    a_normed = normalize_rows(a)
+    b_normed = normalize_rows(b)
+    r = np.dot(a_normed, b_normed.T)
 
     return r
 
 
-def compute_similarity(files=None, type='cosine', hems='L', dense=True, mean_centering=True):
-    dist = []
+def normalize_rows(data, dtype=np.float64):
+    """
+    Scale each row of data to unit euclidean norm, rows with zero norm become nan
+    """
+    data = np.asarray(data, dtype=dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return data / np.sqrt(np.einsum('ij,ij->i', data, data))[:, np.newaxis]
+
+
+def pair_similarity(data, pairs, type='cosine', mean_centering=True, block_size=1024):
+    """
+    Compute the similarity of the given vertex pairs only (e.g. the pairs
+    within a distance radius), without building the dense [N * N] matrix.
+    Rows of the pair matrix are processed in blocks of block_size vertices in
+    float32, so memory is bounded by the number of pairs of one block.
+
+        :param data: ndarray, shape: (n_vertices, n_features) input data
+        :param pairs: sparse matrix [N * N] whose stored entries are the pairs
+                      to compute, e.g. a distance matrix from compute_distance
+        :param type: 'cosine' or 'pearson'
+        :param mean_centering: if True, the data of each vertex is mean centered
+                               before computing the similarity (always done for
+                               'pearson')
+        :param block_size: the number of rows computed at once
+
+        :return:  r - sparse CSR similarity matrix [N * N] with the sparsity
+                  pattern of pairs
+    """
+    if type not in ('cosine', 'pearson'):
+        raise TypeError("Similarity type cannot be recognized!")
+
+    data = np.asarray(data, dtype=np.float32)
+    if mean_centering or type == 'pearson':
+        data = data - data.mean(axis=1)[:, np.newaxis]
+    data = normalize_rows(data, dtype=np.float32)
+
+    pairs = sparse.csr_matrix(pairs)
+    pairs.sort_indices()
+    n_rows = pairs.shape[0]
+
+    similarity = np.empty(pairs.nnz, dtype=np.float32)
+    for start in range(0, n_rows, block_size):
+        stop = min(start + block_size, n_rows)
+        first, last = pairs.indptr[start], pairs.indptr[stop]
+        row = np.repeat(np.arange(start, stop), np.diff(pairs.indptr[start:stop + 1]))
+        col = pairs.indices[first:last]
+        similarity[first:last] = np.einsum('ij,ij->i', data[row], data[col])
+
+    return sparse.csr_matrix((similarity, pairs.indices.copy(), pairs.indptr.copy()),
+                             shape=pairs.shape)
+
+
+def load_data(file_name, mean_centering=True):
+    mat = nb.load(file_name)
+    data = [x.data for x in mat.darrays]
+    data = np.reshape(data, (len(data), len(data[0])))
+    data = data.transpose()
+
+    # mean centering of the subject beta weights
+    if mean_centering:
+        mean = data.mean(axis=1)
+        data = data - mean[:, np.newaxis]  # mean centering
+
+    return data
+
+
+def compute_similarity(files=None, type='cosine', hems='L', dense=True,
+                       mean_centering=True,
+                       pairs=None, block_size=1024):
+    """
+    Compute the similarity matrix between the vertices of a subject.
+
+        :param files: the func.gii data file, default to the group data of hems
+        :param type: 'cosine' or 'pearson'
+        :param hems: the hemisphere of the default data file
+        :param dense: if True, then output the sparse matrix, otherwise the original
+        matrix
+        :param mean_centering: if True, the data of each vertex is mean centered
+        :param pairs: optional sparse matrix [N * N] of the vertex pairs to compute
+                      (e.g. a distance matrix), see pair_similarity(). If given,
+                      the result is always sparse and no dense matrix is built
+        :param block_size: the number of rows computed at once when pairs is given
+
+        :return: the similarity matrix [N * N]
+    """
     if files is None:
         file_name = 'data/group.%s.wbeta.32k.func.gii' % hems
     else:
         file_name = files
 
-    if type is 'cosine':
-        mat = nb.load(file_name)
-        data = [x.data for x in mat.darrays]
-        data = np.reshape(data, (len(data), len(data[0])))
-        data = data.transpose()
-
-        # mean centering of the subject beta weights
-        if mean_centering:
-            mean = data.mean(axis=1)
-            data = data - mean[:, np.newaxis]  # mean centering
-        else:
-            data = data
+    if type not in ('cosine', 'pearson'):
+        raise TypeError("Similarity type cannot be recognized!")
 
-        dist = cosine(data)
-
-    elif type is 'pearson':
-        mat = nb.load(file_name)
-        data = [x.data for x in mat.darrays]
-        data = np.reshape(data, (len(data), len(data[0])))
-        data = data.transpose()
+    data = load_data(file_name, mean_centering)
 
-        # mean centering of the subject beta weights
-        if mean_centering:
-            mean = data.mean(axis=1)
-            data = data - mean[:, np.newaxis]  # mean centering
-        else:
-            data = data
+    if pairs is not None:
+        return pair_similarity(data, pairs, type, mean_centering=False,
+                               block_size=block_size)
 
+    if type == 'cosine':
+        dist = cosine(data)
+    else:
         dist = np.corrcoef(data)
 
     return sparse.csr_matrix(dist) if dense else dist
-
-
-#A = compute_similarity(files='data/s02/s02.L.wbeta.32k.func.gii', type='pearson', dense=False)
-#print(A)
-
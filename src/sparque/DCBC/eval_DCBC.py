@@ -30,14 +30,28 @@ M:                    Gifti object- can be saved as a *.func.gii or *.label.gii
 Author: Da Zhi
 '''
 
+import contextlib
 import os
+import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import nibabel as nb
 import numpy as np
 import scipy
 import scipy.io as spio
-import nibabel as nb
-import warnings
+
+import sparque.cache as cache
+import sparque.utils as utils
+
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
+# compiled distance pairs already loaded in this process, keyed by compiled directory
+_compiled_distances = {}
+# pairs without a subject's nan vertices, keyed by the pairs they were filtered from
+# and the nan pattern
+_subject_pairs = {}
+
 
 def delete_rows_csr(mat, indices):
     """
@@ -144,9 +158,180 @@ def compute_var_cov(data, cond='all', mean_centering=True):
     return cov, var
 
 
+def compute_pair_var_cov(data, row, col, cond='all', mean_centering=True,
+                         block_size=1000000):
+    """
+        Compute the covariance and variance of the given vertex pairs only,
+        instead of the full [N * N] matrices returned by compute_var_cov()
+
+        :param data: subject's connectivity profile, shape [N * k]
+                     N - the size of vertices (voxel)
+                     k - the size of activation conditions
+        :param row: row (vertex) index of each pair, shape [P]
+        :param col: column (vertex) index of each pair, shape [P]
+        :param cond: specify the subset of activation conditions to evaluation
+                    (e.g condition column [1,2,3,4]),
+                     if not given, default to use all conditions
+        :param mean_centering: boolean value to determine whether the given subject data
+                               should be mean centered
+        :param block_size: the number of pairs whose dot products are computed at once,
+                           bounds the temporary memory to block_size * k values
+
+        :return: cov - the covariance of each pair. shape [P]
+                 var - the variance (product of standard deviations) of each pair. shape
+                 [P]
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if mean_centering:
+        mean = data.mean(axis=1)
+        data = data - mean[:, np.newaxis]  # mean centering
+
+    # specify the condition index used to compute correlation, otherwise use all
+    # conditions
+    if not (isinstance(cond, str) and cond == 'all'):
+        data = data[:, cond]
+
+    k = data.shape[1]
+    sd = np.sqrt(np.sum(np.square(data), axis=1) / k)  # standard deviation
+    var = sd[row] * sd[col]
+
+    cov = np.empty(row.shape[0])
+    for start in range(0, row.shape[0], block_size):
+        stop = start + block_size
+        cov[start:stop] = np.einsum('ij,ij->i', data[row[start:stop]],
+                                    data[col[start:stop]]) / k
+    return cov, var
+
+
+def compiled_distance_dir(dist_file, maxDist, binWidth):
+    """
+    The default directory of the compiled pairs of a .mat distance file,
+    next to the distance file and named after the binning it was compiled for
+    """
+    return '%s_pairs_%g_%g' % (os.path.splitext(dist_file)[0], maxDist, binWidth)
+
+
+def compile_distance(dist_file, maxDist, binWidth, compiled_dir=None):
+    """
+        One-time conversion of a .mat distance file (sparse 'avrgDs' matrix) into
+        the vertex pairs within maxDist and their precomputed distance bin, so that
+        evaluate() does not need to load and bin the multi-GB matrix on every call.
+        Bins are computed from the original float64 distances, bin i holding the
+        distances in (i * binWidth, (i + 1) * binWidth].
+
+        :param dist_file: the path of the .mat distance file
+        :param maxDist: the maximum distance for vertices pairs
+        :param binWidth: the spatial binning width in mm
+        :param compiled_dir: the output directory, default to compiled_distance_dir()
+
+        :return: the path of the compiled directory, which holds
+                 row.npy / col.npy - int32 vertex indices of each pair, sorted by row
+                 bin.npy - uint8 (uint16 for more than 255 bins) bin index of each pair
+                 info.npy - [number of vertices, maxDist, binWidth]
+    """
+    if compiled_dir is None:
+        compiled_dir = compiled_distance_dir(dist_file, maxDist, binWidth)
+
+    dist = scipy.sparse.coo_matrix(spio.loadmat(dist_file)['avrgDs'])
+    dist.sum_duplicates()
+    numVertices = dist.shape[0]
+    numBins = int(np.floor(maxDist / binWidth))
+
+    binEdges = np.arange(numBins + 1) * binWidth
+    bins = np.digitize(dist.data, binEdges, right=True) - 1
+    inRange = (bins >= 0) & (bins < numBins)
+
+    row, col, bins = dist.row[inRange], dist.col[inRange], bins[inRange]
+    order = np.lexsort((col, row))
+
+    os.makedirs(compiled_dir, exist_ok=True)
+    np.save(os.path.join(compiled_dir, 'row.npy'), row[order].astype(np.int32))
+    np.save(os.path.join(compiled_dir, 'col.npy'), col[order].astype(np.int32))
+    np.save(os.path.join(compiled_dir, 'bin.npy'),
+            bins[order].astype(np.uint8 if numBins <= 255 else np.uint16))
+    np.save(os.path.join(compiled_dir, 'info.npy'),
+            np.array([numVertices, maxDist, binWidth], dtype=np.float64))
+
+    return compiled_dir
+
+
+def load_distance(dist_file, maxDist, binWidth):
+    """
+        Load the compiled vertex pairs of a distance file as read-only memory maps,
+        compiling the .mat file first if it has not been compiled for this binning.
+        Loaded pairs are kept in process, so repeated calls return immediately.
+
+        :param dist_file: the path of the .mat distance file, or of a directory
+                          written by compile_distance()
+        :param maxDist: the maximum distance for vertices pairs
+        :param binWidth: the spatial binning width in mm
+
+        :return: numVertices - the number of vertices of the distance matrix
+                 row, col - vertex indices of each pair
+                 bins - distance bin of each pair
+    """
+    if os.path.isdir(dist_file):
+        compiled_dir = dist_file
+    else:
+        compiled_dir = compiled_distance_dir(dist_file, maxDist, binWidth)
+        if not os.path.exists(os.path.join(compiled_dir, 'info.npy')):
+            compile_distance(dist_file, maxDist, binWidth, compiled_dir)
+
+    compiled_dir = os.path.abspath(compiled_dir)
+    if compiled_dir not in _compiled_distances:
+        info = np.load(os.path.join(compiled_dir, 'info.npy'))
+        numVertices, compiledMaxDist, compiledBinWidth = info
+        if compiledMaxDist != maxDist or compiledBinWidth != binWidth:
+            raise ValueError("Distance pairs in %s were compiled for maxDist=%g and "
+                             "binWidth=%g"
+                             % (compiled_dir, compiledMaxDist, compiledBinWidth))
+        _compiled_distances[compiled_dir] = (int(numVertices),) + tuple(
+            np.load(os.path.join(compiled_dir, name), mmap_mode='r')
+            for name in ['row.npy', 'col.npy', 'bin.npy'])
+
+    return _compiled_distances[compiled_dir]
+
+
+def filter_pairs(row, col, bins, excluded):
+    """
+        Drop the vertex pairs touching an excluded vertex with a vectorized keep-mask.
+        The pairs are returned as they are (e.g. still memory-mapped) if no vertex
+        is excluded.
+
+        :param row, col, bins: the vertex pairs and their distance bin
+        :param excluded: boolean mask of the vertices to exclude, shape [N]
+
+        :return: row, col, bins of the remaining pairs, in their original vertex indices
+    """
+    if not excluded.any():
+        return row, col, bins
+    keep = ~(excluded[row] | excluded[col])
+    return row[keep], col[keep], bins[keep]
+
+
+def cached_pairs(key, row, col, bins, excluded):
+    """
+        filter_pairs() with the result cached by exclusion pattern. Only the pairs of
+        the most recent pattern are kept, since consecutive subjects usually share it
+        and pair lists are large.
+
+        :param key: the key of the pairs to filter, e.g. the distance file and the
+                    medial wall they were filtered with
+        :param row, col, bins: the vertex pairs and their distance bin
+        :param excluded: boolean mask of the vertices to exclude, shape [N]
+
+        :return: row, col, bins of the remaining pairs, in their original vertex indices
+    """
+    key = key + (cache.array_hash(excluded),)
+    if key not in _subject_pairs:
+        _subject_pairs.clear()
+        _subject_pairs[key] = filter_pairs(row, col, bins, excluded)
+    return _subject_pairs[key]
+
+
 class DCBC:
     def __init__(self, hems='all', maxDist=35, binWidth=1, parcellation=np.empty([]),
-                 dist_file=None, weighting=True):
+                 dist_file=None, weighting=True, sparse=True):
         """
         Constructor of DCBC class
         :param hems:        Hemisphere to test. 'L' - left hemisphere; 'R' - right hemisphere; 'all' - both hemispheres
@@ -154,9 +339,16 @@ class DCBC:
         :param binWidth:    The spatial binning width in mm, default 1 mm
         :param parcellation:
         :param dist_file:   The path of distance metric of vertices pairs, for example Dijkstra's distance, GOD distance
-                            Euclidean distance. Dijkstra's distance as default
+                            Euclidean distance. Dijkstra's distance as default. Either the
+                            .mat file or a directory
+                            written by compile_distance(); a .mat file is compiled on
+                            first use
         :param weighting:   Boolean value. True - add weighting scheme to DCBC (default)
                                            False - no weighting scheme to DCBC
+        :param sparse:      Boolean value. True - compute covariance and variance only for
+        the
+                                                  vertex pairs within maxDist (default)
+                                           False - compute the dense [N * N] matrices
         """
         self.hems = hems
         self.maxDist = maxDist
@@ -164,22 +356,38 @@ class DCBC:
         self.parcellation = parcellation
         self.dist_file = dist_file
         self.weighting = weighting
+        self.sparse = sparse
 
-    def evaluate(self, parcellation):
+    def evaluate(self, parcellation, n_jobs=1):
         """
         The public function that handle the main DCBC evaluation routine
 
-        :param parcellation: The cortical parcellation to evaluate
+        :param parcellation: The cortical parcellation to evaluate, or a dict of
+                             parcellations by hemisphere, e.g. {'L': ..., 'R': ...}
+        :param n_jobs:       The number of worker processes, see evaluate_many()
         :return: dict T that contain all needed DCBC evaluation results
         """
-        numBins = int(np.floor(self.maxDist / self.binWidth))
+        return self.evaluate_many([parcellation], n_jobs=n_jobs)[0]
+
+    def evaluate_many(self, parcellations, n_jobs=1):
+        """
+        Evaluate several parcellations at once. The subject data, the vertex pairs
+        and their covariance and variance are computed once per subject and
+        hemisphere, only the within/between labelling of the pairs is done per
+        parcellation.
+
+        :param parcellations: list of cortical parcellations to evaluate, each either
+                              an array used for every hemisphere or a dict of arrays
+                              by hemisphere, e.g. {'L': ..., 'R': ...}
+        :param n_jobs:        The number of worker processes the (subject, hemisphere)
+                              evaluations are spread over, -1 to use all cores. The
+                              vertex pairs are filtered once in this process and
+                              memory-mapped read-only by every worker.
+        :return: list of dict T (see evaluate()), one per parcellation
+        """
         subjectsDir = scan_subdirs('data')
 
-        if self.dist_file is not None:
-            dist = spio.loadmat(self.dist_file)['avrgDs']
-            dist = dist.astype('float16')
-            dist = dist.tocsr()
-        else:
+        if self.dist_file is None:
             raise TypeError("Distance file cannot be found!")
 
         # Determine which hemisphere shall be evaluated
@@ -190,68 +398,156 @@ class DCBC:
         else:
             raise TypeError("Hemisphere type cannot be recognized!")
 
-        D = dict()
-        for h in hems:
-            print('evaluating %s hemisphere of ' % h, end=' ')
-            for dir in subjectsDir:
-                print('%s ' % dir, end=' ')
-                path = os.path.join('data', dir)
-                data = load_subjectData(path, hemis=h)
-
-                # remove nan value and medial wall from subject data
-                nanIdx = np.union1d(np.unique(np.where(np.isnan(data))[0]), np.where(parcellation == 0)[0])
-                data = np.delete(data, nanIdx, axis=0)
-                cov, var = compute_var_cov(data)  # This line can be changed to use compute_corr()
-
-                # remove the nan value and medial wall from dist file
-                this_dist = delete_rows_csr(dist, nanIdx)
-                this_dist = delete_cols_csr(this_dist, nanIdx)
-                row, col, distance = scipy.sparse.find(this_dist)
-
-                # making parcellation matrix without medial wall and nan value
-                par = np.delete(parcellation, nanIdx, axis=0)
-                num_within, num_between, corr_within, corr_between = [], [], [], []
-                for i in range(numBins):
-                    inBin = np.where((distance > i * self.binWidth) & (distance <= (i + 1) * self.binWidth))[0]
-
-                    # lookup the row/col index of within and between vertices
-                    within = np.where((par[row[inBin]] == par[col[inBin]]) == True)[0]
-                    between = np.where((par[row[inBin]] == par[col[inBin]]) == False)[0]
-
-                    # retrieve and append the number of vertices for within/between in current bin
-                    num_within = np.append(num_within, within.shape[0])
-                    num_between = np.append(num_between, between.shape[0])
-
-                    # Compute and append averaged within- and between-parcel correlations in current bin
-                    this_corr_within = np.nanmean(cov[row[inBin[within]], col[inBin[within]]]) / np.nanmean(var[row[inBin[within]], col[inBin[within]]])
-                    this_corr_between = np.nanmean(cov[row[inBin[between]], col[inBin[between]]]) / np.nanmean(var[row[inBin[between]], col[inBin[between]]])
-                    corr_within = np.append(corr_within, this_corr_within)
-                    corr_between = np.append(corr_between, this_corr_between)
-
-                    del inBin
-
-                if self.weighting:
-                    weight = 1/(1/num_within + 1/num_between)
-                    weight = weight / np.sum(weight)
-                    DCBC = np.nansum(np.multiply((corr_within - corr_between), weight))
+        hemParcellations = {h: [np.asarray(parcellation[h]
+                                           if isinstance(parcellation, dict)
+                                           else parcellation)
+                                for parcellation in parcellations] for h in hems}
+
+        # one task per (subject, hemisphere), in the order of the serial evaluation
+        taskDirs = [dir for h in hems for dir in subjectsDir]
+        taskHems = [h for h in hems for dir in subjectsDir]
+        taskParcellations = [hemParcellations[h] for h in taskHems]
+
+        _, row, col, bins = load_distance(self.dist_file, self.maxDist, self.binWidth)
+
+        Ds = [dict() for _ in parcellations]
+        with contextlib.ExitStack() as stack:
+            if n_jobs != 1:
+                shared_dir = stack.enter_context(tempfile.TemporaryDirectory())
+
+            hemPairs, hemKeys = {}, {}
+            for h in hems:
+                # vertices on the medial wall of every parcellation never enter a pair,
+                # the pairs without them are filtered once and shared by every subject
+                commonWall = np.all([parcellation == 0
+                                     for parcellation in hemParcellations[h]],
+                                    axis=0)
+                pairs = filter_pairs(row, col, bins, commonWall)
+                hemKeys[h] = (os.path.abspath(self.dist_file), self.maxDist,
+                              self.binWidth, h, cache.array_hash(commonWall))
+                if n_jobs == 1:
+                    hemPairs[h] = pairs
+                elif commonWall.any():
+                    hemPairs[h] = tuple(utils.save_shared_array(array, shared_dir)
+                                        for array in pairs)
                 else:
-                    DCBC = np.nansum(corr_within - corr_between)
-                    weight = np.nan
-
-                D[dir + '_' + h] = {
-                    "binWidth": self.binWidth,
-                    "maxDist": self.maxDist,
-                    "hemisphere": h,
-                    "num_within": num_within,
-                    "num_between": num_between,
-                    "corr_within": corr_within,
-                    "corr_between": corr_between,
-                    "weight": weight,
-                    "DCBC": DCBC
-                }
+                    # the compiled pairs are memory-mapped from their own files
+                    hemPairs[h] = tuple(array.filename for array in pairs)
+                del pairs
+            taskPairs = [hemPairs[h] for h in taskHems]
+            taskKeys = [hemKeys[h] for h in taskHems]
+
+            if n_jobs == 1:
+                results = map(self._evaluate_subject, taskDirs, taskHems,
+                              taskParcellations, taskPairs, taskKeys)
+            else:
+                executor = stack.enter_context(
+                    ProcessPoolExecutor(max_workers=utils.get_n_jobs(n_jobs)))
+                results = executor.map(self._evaluate_subject_from_shared, taskDirs,
+                                       taskHems, taskParcellations, taskPairs, taskKeys)
+
+            for i, (dir, h, subjectResults) in enumerate(zip(taskDirs, taskHems,
+                                                             results)):
+                if i % len(subjectsDir) == 0:
+                    print('evaluating %s hemisphere of ' % h, end=' ')
+                print('%s ' % dir, end=' ')
+                for D, T in zip(Ds, subjectResults):
+                    D[dir + '_' + h] = T
+                if i % len(subjectsDir) == len(subjectsDir) - 1:
+                    print('\n Done evaluation of %s hemisphere.' % h)
+        return Ds
+
+    def _evaluate_subject_from_shared(self, dir, h, parcellations, pairFiles,
+                                      pairsKey):
+        """
+        _evaluate_subject() in a worker process, with the vertex pairs memory-mapped
+        from the files they were shared through
+        """
+        pairs = tuple(utils.load_shared_array(filename) for filename in pairFiles)
+        return self._evaluate_subject(dir, h, parcellations, pairs, pairsKey)
 
-            print('\n Done evaluation of %s hemisphere.' % h)
-        return D
+    def _evaluate_subject(self, dir, h, parcellations, pairs, pairsKey):
+        """
+        Evaluate all parcellations for the data of one subject and hemisphere
+
+        :param dir: the subject folder under 'data'
+        :param h: the hemisphere
+        :param parcellations: list of cortical parcellations of this hemisphere
+        :param pairs: the (row, col, bins) vertex pairs of this hemisphere, without
+                      the medial wall common to every parcellation
+        :param pairsKey: the key identifying these pairs in the cache of cached_pairs()
+        :return: list of DCBC results (see _score_pairs()), one per parcellation
+        """
+        numBins = int(np.floor(self.maxDist / self.binWidth))
 
+        path = os.path.join('data', dir)
+        data = load_subjectData(path, hemis=h)
 
+        # remove the pairs touching a nan value of this subject, subjects with the
+        # same nan pattern reuse the same pairs
+        isNan = np.isnan(data).any(axis=1)
+        if isNan.any():
+            row, col, bins = cached_pairs(pairsKey, *pairs, isNan)
+        else:
+            row, col, bins = pairs
 
+        if self.sparse:
+            pair_cov, pair_var = compute_pair_var_cov(data, row, col)
+        else:
+            # This line can be changed to use compute_corr()
+            cov, var = compute_var_cov(data)
+            pair_cov, pair_var = cov[row, col], var[row, col]
+            del cov, var
+
+        results = []
+        for parcellation in parcellations:
+            results.append(self._score_pairs(parcellation, row, col, bins, pair_cov,
+                                             pair_var, numBins, h))
+        return results
+
+    def _score_pairs(self, par, row, col, bins, pair_cov, pair_var, numBins, h):
+        """
+        Compute the DCBC of one subject and hemisphere from its binned vertex pairs
+        and their covariance and variance, pairs touching the medial wall (label 0)
+        of the parcellation are ignored
+        """
+        labelled = (par[row] != 0) & (par[col] != 0)
+        if not np.all(labelled):
+            row, col, bins = row[labelled], col[labelled], bins[labelled]
+            pair_cov, pair_var = pair_cov[labelled], pair_var[labelled]
+
+        # accumulate counts and sums of the pairs in one pass, grouped by (bin,
+        # within-parcel)
+        within = par[row] == par[col]
+        group = 2 * bins.astype(np.int64) + within
+        counts = np.bincount(group, minlength=2 * numBins).reshape(numBins, 2)
+        sum_cov = np.bincount(group, weights=pair_cov, minlength=2 * numBins)
+        sum_cov = sum_cov.reshape(numBins, 2)
+        sum_var = np.bincount(group, weights=pair_var, minlength=2 * numBins)
+        sum_var = sum_var.reshape(numBins, 2)
+
+        num_within, num_between = counts[:, 1].astype(float), counts[:, 0].astype(float)
+
+        # averaged within- and between-parcel correlations, NaN for empty bins
+        corr = sum_cov / sum_var
+        corr_within, corr_between = corr[:, 1], corr[:, 0]
+
+        if self.weighting:
+            weight = 1/(1/num_within + 1/num_between)
+            weight = weight / np.sum(weight)
+            DCBC = np.nansum(np.multiply((corr_within - corr_between), weight))
+        else:
+            DCBC = np.nansum(corr_within - corr_between)
+            weight = np.nan
+
+        return {
+            "binWidth": self.binWidth,
+            "maxDist": self.maxDist,
+            "hemisphere": h,
+            "num_within": num_within,
+            "num_between": num_between,
+            "corr_within": corr_within,
+            "corr_between": corr_between,
+            "weight": weight,
+            "DCBC": DCBC
+        }
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import uuid
+import warnings
+
+import numpy as np
+
+# default upper bound on the total size of a cache directory (20 GB)
+MAX_CACHE_BYTES = 20 * 1024 ** 3
+
+# subdirectory of a cache directory remembering the content hashes of files
+FILE_HASHES_DIR = 'file_hashes'
+
+_file_hashes = {}
+
+def file_hash(filename, chunk_size = 2 ** 24, cache_dir = None):
+    '''
+    Returns the SHA-1 of the content of a file. Hashes are remembered for the lifetime of
+    the process, and in `cache_dir` if given, as long as the path, size and modification
+    time of the file do not change, so later processes only stat the file.
+    '''
+    stat = os.stat(filename)
+    stat_key = (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+    if stat_key in _file_hashes:
+        return _file_hashes[stat_key]
+
+    hash_filename = None
+    if cache_dir is not None:
+        stat_hash = hashlib.sha1(repr(stat_key).encode()).hexdigest()
+        hash_filename = os.path.join(cache_dir, FILE_HASHES_DIR, stat_hash)
+        try:
+            with open(hash_filename) as f:
+                _file_hashes[stat_key] = f.read()
+            return _file_hashes[stat_key]
+        except FileNotFoundError:
+            pass
+
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    _file_hashes[stat_key] = sha.hexdigest()
+
+    if hash_filename is not None:
+        os.makedirs(os.path.dirname(hash_filename), exist_ok = True)
+        tmp_filename = f'{hash_filename}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write(_file_hashes[stat_key])
+        os.replace(tmp_filename, hash_filename)
+
+    return _file_hashes[stat_key]
+
+def array_hash(array):
+    '''
+    Returns the SHA-1 of the shape, dtype and values of an array (e.g. a mask used when
+    loading a scan)
+    '''
+    array = np.ascontiguousarray(array)
+    sha = hashlib.sha1(f'{array.shape}{array.dtype}'.encode())
+    sha.update(array.tobytes())
+    return sha.hexdigest()
+
+def cache_key(filename, cache_dir = None, **params):
+    '''
+    Builds the cache key of a file processed with the given parameters. The key depends on
+    the content of the file, not on its path, so renamed or copied scans share entries.
+    The hash of the content is remembered in `cache_dir` (see `file_hash`).
+    '''
+    sha = hashlib.sha1(file_hash(filename, cache_dir = cache_dir).encode())
+    for name in sorted(params):
+        sha.update(f'{name}={params[name]!r};'.encode())
+    return sha.hexdigest()
+
+def _entry_filenames(cache_dir, key, n_arrays):
+    return [os.path.join(cache_dir, f'{key}_{i}.npy') for i in range(n_arrays)]
+
+def load_cached(cache_dir, key, n_arrays = 1):
+    '''
+    Memory-maps the arrays stored under `key`, or returns None if any of them is missing.
+    Hits refresh the modification time of the entry, which is what eviction orders on.
+    '''
+    filenames = _entry_filenames(cache_dir, key, n_arrays)
+    try:
+        arrays = tuple(np.load(filename, mmap_mode = 'r') for filename in filenames)
+        for filename in filenames:
+            os.utime(filename)
+    except FileNotFoundError:
+        return None
+    return arrays
+
+def save_cached(cache_dir, key, arrays, max_cache_bytes = MAX_CACHE_BYTES):
+    '''
+    Stores `arrays` under `key` as `.npy` files, then evicts the least recently used
+    other entries until the cache directory fits in `max_cache_bytes`. Files are written
+    under a temporary name and renamed, so concurrent processes never read a partial
+    entry.
+    '''
+    os.makedirs(cache_dir, exist_ok = True)
+    for filename, array in zip(_entry_filenames(cache_dir, key, len(arrays)), arrays):
+        tmp_filename = f'{filename}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_filename, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_filename, filename)
+
+    evict(cache_dir, max_cache_bytes, keep_key = key)
+
+def evict(cache_dir, max_cache_bytes = MAX_CACHE_BYTES, keep_key = None):
+    '''
+    Deletes the least recently used entries of `cache_dir`, with all their `.npy` files,
+    until their total size is at most `max_cache_bytes`. The entry `keep_key` (e.g. the
+    one just written) is never deleted; a warning is issued if it alone exceeds
+    `max_cache_bytes`.
+    '''
+    # an entry is the files `{key}_{i}.npy`, last used when any of them was
+    entries = {}
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.npy'):
+            stat = entry.stat()
+            key = entry.name[:-len('.npy')].rsplit('_', 1)[0]
+            mtime_ns, size, filenames = entries.get(key, (0, 0, []))
+            entries[key] = (max(mtime_ns, stat.st_mtime_ns), size + stat.st_size,
+                            filenames + [entry.path])
+
+    total_bytes = sum(size for _, size, _ in entries.values())
+    if keep_key in entries and entries[keep_key][1] > max_cache_bytes:
+        warnings.warn(f'cache entry {keep_key} ({entries[keep_key][1]} bytes) is larger '
+                      f'than the cache size bound of {max_cache_bytes} bytes')
+
+    by_last_use = sorted(entries.items(), key = lambda item: item[1][0])
+    for key, (_, size, filenames) in by_last_use:
+        if total_bytes <= max_cache_bytes:
+            break
+        if key == keep_key:
+            continue
+        for filename in filenames:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+        total_bytes -= size
+
+def get_or_compute(cache_dir, key, compute, n_arrays = 1,
+                   max_cache_bytes = MAX_CACHE_BYTES):
+    '''
+    Returns the arrays cached under `key` (memory-mapped), computing them with `compute()`
+    and storing them on a miss. If `cache_dir` is None, `compute()` is called directly.
+
+    Parameters
+    -----
+    cache_dir : str
+        Directory of the cache
+    key : str
+        Cache key, see `cache_key`
+    compute : callable
+        Function without arguments returning a tuple of `n_arrays` arrays
+    n_arrays (optional) : int
+        Number of arrays returned by `compute`
+    max_cache_bytes (optional) : int
+        Size bound of the cache directory
+
+    Returns
+    -----
+    tuple
+        Arrays returned by `compute`
+    '''
+    if cache_dir is None:
+        return compute()
+
+    arrays = load_cached(cache_dir, key, n_arrays)
+    if arrays is None:
+        arrays = compute()
+        save_cached(cache_dir, key, arrays, max_cache_bytes)
+    return arrays
@@ -0,0 +1,145 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# file names within a connectome store directory
+EDGES_FILE = 'edges.f32'
+METADATA_FILE = 'metadata.csv'
+INFO_FILE = 'info.json'
+
+METADATA_COLUMNS = ['subject', 'session', 'label']
+
+def is_conn_store(path):
+    '''
+    Returns true if `path` is a connectome store directory (see `write_conn_store`)
+    '''
+    return (isinstance(path, (str, os.PathLike))
+            and os.path.isfile(os.path.join(path, INFO_FILE)))
+
+def write_conn_store(store_dir, subjects, sessions, edges, labels = None, append = False):
+    '''
+    Writes edge lists of connectivity matrices to a binary connectome store, replacing the
+    wide edge-list `.csv`. A store is a directory holding the edges as one contiguous
+    row-major float32 (sessions x edges) file, which `load_conn_store` memory-maps, and
+    the subject, session and label of each row in a small `.csv` beside it.
+
+    Parameters
+    -----
+    store_dir : str
+        Directory of the store, created if needed
+    subjects : array_like
+        Subject of each session
+    sessions : array_like
+        Session name of each session
+    edges : array_like
+        Edge lists of the connectivity matrices, shape (sessions, edges)
+    labels (optional) : array_like
+        Label of each session used for classification. Subjects are used by default
+    append (optional) : bool
+        If true and the store exists, rows are appended to it. Otherwise an existing store
+        is overwritten
+
+    Returns
+    -----
+    store_dir : str
+        Directory of the store
+    '''
+    edges = np.ascontiguousarray(edges, dtype = '<f4')
+    if edges.ndim != 2:
+        raise ValueError(f'edges must be 2D (sessions x edges), got shape {edges.shape}')
+    if labels is None:
+        labels = subjects
+
+    metadata = pd.DataFrame({'subject': np.asarray(subjects),
+                             'session': np.asarray(sessions),
+                             'label': np.asarray(labels)},
+                            columns = METADATA_COLUMNS)
+    if len(metadata) != edges.shape[0]:
+        raise ValueError(f'{len(metadata)} metadata rows for {edges.shape[0]} edge rows')
+
+    append = append and is_conn_store(store_dir)
+    if append:
+        with open(os.path.join(store_dir, INFO_FILE)) as f:
+            n_edges = json.load(f)['n_edges']
+        if n_edges != edges.shape[1]:
+            raise ValueError(f'cannot append {edges.shape[1]} edges to a store of '
+                             f'{n_edges} edges')
+    else:
+        os.makedirs(store_dir, exist_ok = True)
+        with open(os.path.join(store_dir, INFO_FILE), 'w') as f:
+            json.dump({'n_edges': edges.shape[1], 'dtype': '<f4'}, f)
+
+    edges_filename = os.path.join(store_dir, EDGES_FILE)
+    if append:
+        # edges are written before their metadata, so an interrupted append can leave
+        # edge rows without metadata; drop them so new rows stay aligned
+        n_rows = len(pd.read_csv(os.path.join(store_dir, METADATA_FILE), dtype = str))
+        with open(edges_filename, 'r+b') as f:
+            f.truncate(n_rows * n_edges * edges.itemsize)
+
+    with open(edges_filename, 'ab' if append else 'wb') as f:
+        edges.tofile(f)
+    metadata.to_csv(os.path.join(store_dir, METADATA_FILE), mode = 'a' if append else 'w',
+                    header = not append, index = False)
+
+    return store_dir
+
+def load_conn_store(store_dir, mode = 'r'):
+    '''
+    Loads a connectome store (see `write_conn_store`) without reading its edges.
+    Metadata columns are read as str. Raises a ValueError if the number of edge rows
+    does not match the metadata.
+
+    Returns
+    -----
+    metadata : dataframe
+        Subject, session and label of each row
+    edges : array_like
+        Memory-mapped float32 edge lists, shape (sessions, edges)
+    '''
+    with open(os.path.join(store_dir, INFO_FILE)) as f:
+        info = json.load(f)
+    metadata = pd.read_csv(os.path.join(store_dir, METADATA_FILE), dtype = str,
+                           keep_default_na = False)
+
+    shape = (len(metadata), info['n_edges'])
+    edges_filename = os.path.join(store_dir, EDGES_FILE)
+    n_edge_values = os.path.getsize(edges_filename) // np.dtype(info['dtype']).itemsize
+    if n_edge_values != shape[0] * shape[1]:
+        raise ValueError(f'{store_dir} holds {n_edge_values / shape[1]:g} edge rows for '
+                         f'{shape[0]} metadata rows, probably from an interrupted write. '
+                         'Appending to the store drops the extra edge rows.')
+    if shape[0] == 0:
+        return metadata, np.empty(shape, dtype = info['dtype'])
+    edges = np.memmap(edges_filename, dtype = info['dtype'], mode = mode, shape = shape)
+    return metadata, edges
+
+def conn_df_to_store(conn_df, store_dir, func_conn_col_start = 2, append = False):
+    '''
+    Converts a dataframe of edge lists (output from `func_conn.conn_from_dir`) or the
+    `.csv` it was saved to into a connectome store. Edge list values are the columns from
+    `func_conn_col_start` on, except `label`. Use `func_conn_col_start=3` for a saved
+    `.csv`, whose first column is the index.
+    '''
+    if not isinstance(conn_df, pd.DataFrame):
+        conn_df = pd.read_csv(conn_df)
+
+    edges = conn_df.iloc[:,func_conn_col_start:]
+    edges = edges.drop(columns = 'label', errors = 'ignore').to_numpy(dtype = np.float32)
+    labels = conn_df['label'] if 'label' in conn_df.columns else None
+    return write_conn_store(store_dir, conn_df['subject'], conn_df['session'], edges,
+                            labels, append)
+
+def conn_store_to_df(store_dir):
+    '''
+    Loads a connectome store into a dataframe laid out like the output of
+    `func_conn.conn_from_dir` (subject, session, edge list values, label)
+    '''
+    metadata, edges = load_conn_store(store_dir)
+    conn_df = pd.DataFrame(np.array(edges), columns = range(2, edges.shape[1] + 2))
+    conn_df.insert(0, 'session', metadata['session'])
+    conn_df.insert(0, 'subject', metadata['subject'])
+    conn_df['label'] = metadata['label']
+    return conn_df
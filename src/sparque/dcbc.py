@@ -1,9 +1,11 @@
-import os 
+import os
+
 import pandas as pd
 
 import sparque.utils as utils
-from .DCBC import eval_DCBC
-from .DCBC import plotting
+
+from .DCBC import eval_DCBC, plotting
+
 
 def compute_DCBC(nb_loaded_parcel_gii, hem, dist_file, plot=False):
     '''
@@ -41,10 +43,21 @@ def conform_scans_to_dcbc_dir(scans):
             
             _, _ = utils.convert_mni_to_fslr32k(curr_scan, save=True, filename = [f'data/{scan_split[0]}_{scan_split[1]}/{scan_split[0]}_{scan_split[1]}.L.wbeta.32k.func.gii', f'data/{scan_split[0]}_{scan_split[1]}/{scan_split[0]}_{scan_split[1]}.R.wbeta.32k.func.gii'])
 
+def DCBC_to_df(T, parc_name):
+    '''
+    Converts the output of `DCBC.evaluate()` into a dataframe with one row per subject and
+    hemisphere
+    '''
+    DCBC_df = pd.DataFrame.from_dict(T)
+    DCBC_df = DCBC_df.T
+    DCBC_df['parcellation'] = parc_name
+    return DCBC_df
+
 def run_DCBC(dist_file,
              parc_name,
              parcel_filenames,
-             csv_filename = None):
+             csv_filename = None,
+             n_jobs = 1):
     """
     Function used by `run_all_metrics()` to run DCBC. Can be used without `sparque ` wrapper.
 
@@ -58,6 +71,9 @@ def run_DCBC(dist_file,
         List of filepaths as str to left surface image of parcellation and right surface image (please make sure order is right)
     csv_filename (optional) : str
         Name of output to save if desired. Must end in `.csv`
+    n_jobs (optional) : int
+        Number of worker processes the subjects and hemispheres are spread over (-1 to use
+        all cores)
 
     Returns:
     -------
@@ -67,25 +83,64 @@ def run_DCBC(dist_file,
         minimal dataframe containing only hemisphere and DCBC value 
 
     """
-    parcel_fslr_map_L = parcel_filenames[0]
-    parcel_fslr_map_R = parcel_filenames[1]
+    (DCBC_df, DCBC_average), = run_DCBC_many(dist_file, [parc_name], [parcel_filenames],
+                                             [csv_filename], n_jobs)
+
+    return DCBC_df, DCBC_average
+
+def run_DCBC_many(dist_file,
+                  parc_names,
+                  all_parcel_filenames,
+                  csv_filenames = None,
+                  n_jobs = 1):
+    """
+    Runs DCBC for several parcellations, loading each subject's data and computing its
+    covariance once per hemisphere for all of them (see `DCBC.evaluate_many()`).
+
+    Parameters:
+    -------
+    dist_file : str
+        Filepath to distance matrix file
+    parc_names : array_like
+        List of parcellation names as str
+    all_parcel_filenames : array_like
+        List of [left, right] surface images of each parcellation (same as
+        `parcel_filenames` in `run_DCBC()`)
+    csv_filenames (optional) : array_like
+        List of output names as str, one per parcellation. Must end in `.csv`
+    n_jobs (optional) : int
+        Number of worker processes the subjects and hemispheres are spread over (-1 to use
+        all cores)
+
+    Returns:
+    -------
+    array_like
+        List of (DCBC_df, DCBC_average) tuples (see `run_DCBC()`), one per parcellation
+    """
+    if csv_filenames is None:
+        csv_filenames = [None] * len(parc_names)
+
+    parcels = [{'L': parcel_filenames[0].darrays[0].data,
+                'R': parcel_filenames[1].darrays[0].data}
+               for parcel_filenames in all_parcel_filenames]
 
-    L_myDCBC = compute_DCBC(parcel_fslr_map_L, 'L', dist_file)
-    L_myDCBC = pd.DataFrame.from_dict(L_myDCBC)
-    L_myDCBC = L_myDCBC.T
-    L_myDCBC['parcellation'] = parc_name
+    # both hemispheres are evaluated in one pass so subjects and hemispheres share the
+    # worker pool
+    myDCBC = eval_DCBC.DCBC(hems = 'all', maxDist = 35, binWidth = 2.5,
+                            dist_file = dist_file)
 
-    R_myDCBC = compute_DCBC(parcel_fslr_map_R, 'R', dist_file)
-    R_myDCBC = pd.DataFrame.from_dict(R_myDCBC)
-    R_myDCBC = R_myDCBC.T
-    R_myDCBC['parcellation'] = parc_name
+    all_DCBC = []
+    all_T = myDCBC.evaluate_many(parcels, n_jobs = n_jobs)
+    for parc_name, T, csv_filename in zip(parc_names, all_T, csv_filenames):
+        DCBC_df = DCBC_to_df(T, parc_name)
 
-    DCBC_df = pd.concat([L_myDCBC, R_myDCBC])
+        DCBC_df['DCBC'] = DCBC_df['DCBC'].astype('float64')
 
-    DCBC_df['DCBC'] = DCBC_df['DCBC'].astype('float64')
+        if csv_filename is not None:
+            DCBC_df.to_csv(csv_filename, sep = ',')
 
-    DCBC_df.to_csv(csv_filename, sep = ',')
+        DCBC_average = DCBC_df[['hemisphere', 'DCBC']]
 
-    DCBC_average = DCBC_df[['hemisphere', 'DCBC']]
+        all_DCBC += [(DCBC_df, DCBC_average)]
 
-    return DCBC_df, DCBC_average
\ No newline at end of file
+    return all_DCBC
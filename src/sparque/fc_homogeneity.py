@@ -1,65 +1,251 @@
-import sparque.utils as utils
+import contextlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
 import numpy as np
 import pandas as pd
 
+import sparque.cache as cache
+import sparque.utils as utils
+
+
+def zscore_ts(fdata):
+    '''
+    Z-scores each time series (row) of `fdata` using the population standard deviation
+    '''
+    centered_data = fdata - fdata.mean(axis=1, keepdims=True)
+    return centered_data / np.sqrt(np.mean(np.square(centered_data), axis=1,
+                                           keepdims=True))
+
+def parcel_fc_homogeneity(parcel_data):
+    '''
+    Computes the mean of the voxelwise correlation matrix of a parcel without building the
+    matrix.
+
+    Each correlation is the dot product of two z-scored time series divided by the number
+    of time points, so the sum of the whole matrix (diagonal included) is the squared norm
+    of the summed z-scored time series divided by the number of time points. This makes
+    the cost O(voxels x time) instead of O(voxels^2 x time).
+
+    Parameters
+    -------
+    parcel_data : array_like
+        Voxel time series of a single parcel, shape (voxels, time)
+
+    Returns
+    -------
+    float
+        Mean of the voxelwise correlation matrix of the parcel, equivalent to
+        `np.mean(np.corrcoef(parcel_data))`
+    '''
+    n_voxels, n_timepoints = parcel_data.shape
+    z_sum = zscore_ts(parcel_data).sum(axis=0)
+    return np.dot(z_sum, z_sum) / n_timepoints / n_voxels ** 2
+
+def fc_homogeneity_from_index(parcel_index, z_fdata):
+    '''
+    Computes FC homogeneity of every parcel in a label index (see
+    `utils.build_parcel_index`) in a single pass over the voxels.
+
+    Parameters
+    -------
+    parcel_index : tuple
+        Label index `(parcels, order, offsets)` whose voxel indices refer to the rows of
+        `z_fdata`
+    z_fdata : array_like
+        Z-scored voxel time series (see `zscore_ts`), shape (voxels, time)
+
+    Returns
+    -------
+    float
+        Mean FC homogeneity across parcels
+    array_like
+        FC homogeneity of each parcel, in the order of `parcels`
+    '''
+    parcels, order, offsets = parcel_index
+    if parcels.size == 0:
+        return np.nan, []
+
+    n_voxels = np.diff(offsets)
+    n_timepoints = z_fdata.shape[-1]
+
+    # the members of each parcel are contiguous once sorted, so their sums are a single
+    # reduceat. Sums are accumulated in float64 even for float32 time series, since they
+    # run over thousands of voxels and are squared
+    z_sums = np.add.reduceat(z_fdata[order], offsets[:-1], axis=0, dtype=np.float64)
+    fc_homogeneity = np.einsum('ij,ij->i', z_sums, z_sums) / n_timepoints / n_voxels ** 2
+
+    return np.mean(fc_homogeneity), fc_homogeneity.tolist()
+
 def calc_fc_homogeneity(atlas_fdata, fdata):
-    unique_parcels = utils.get_unique_parcels(atlas_fdata)
-
-    fc_homogeneity = []
-
-    for _, curr_parcel in enumerate(unique_parcels):
-        # if curr_parcel in null_labels:
-        #     print(f'Skipping parcel {curr_parcel} because it is a null label')
-        # else:
-        #     print(f'Computing FC homogeneity for parcel {curr_parcel}')
-        #     parcel = (atlas_fdata == curr_parcel)
-        #     parcel_data = fdata[parcel.squeeze()]
-        #     conn_vox_parcel = np.corrcoef(parcel_data)
-        #     curr_fc_homogeneity = np.mean(conn_vox_parcel)
-        #     fc_homogeneity += [curr_fc_homogeneity]
-        parcel = (atlas_fdata == curr_parcel)
-        parcel_data = fdata[parcel.squeeze()]
-        conn_vox_parcel = np.corrcoef(parcel_data)
-        curr_fc_homogeneity = np.mean(conn_vox_parcel)
-        fc_homogeneity += [curr_fc_homogeneity]
-    return np.mean(fc_homogeneity), fc_homogeneity 
-
-def run_fc_homogeneity_from_dir(scans, parc_name, parc_fdata, csv_filename, surface, null_labels=()):
-    fchs_df = {'parcellation': [], 'subject': [], 'session': [], 'fchs': [], 'all_fchs': []}
-
-    for i, curr_scan in enumerate(scans):
-        if surface:
-            _, fdata = utils.load_data(curr_scan, is_surface=True, null_labels = null_labels)
+    parcel_index = utils.build_parcel_index(atlas_fdata)
+    return fc_homogeneity_from_index(parcel_index, zscore_ts(fdata))
+
+def load_filtered_scan(curr_scan, surface, null_labels=(), std_tol_max=1e-5, mask=None,
+                       dtype=np.float32, cache_dir=None):
+    '''
+    Loads the in-mask voxels of a scan as (voxels, time) with `utils.load_masked_data`,
+    drops voxels whose time series has a standard deviation below `std_tol_max` and
+    z-scores the rest.
+
+    If `cache_dir` is given, the kept voxels of the whole scan (its in-brain voxels) are
+    stored there (see `cache.get_or_compute`), keyed by the content of the scan and the
+    preprocessing parameters but not by `mask`. Later calls take the in-mask voxels from
+    the memory-mapped entry instead of decoding the scan again, whatever parcellations
+    `mask` was built from.
+
+    Returns
+    -------
+    z_fdata : array_like
+        Z-scored time series of the kept voxels, shape (kept voxels, time)
+    keep : array_like
+        Boolean mask over the in-mask voxels of the scan marking the kept voxels
+    '''
+    def preprocess_scan(mask):
+        _, fdata = utils.load_masked_data(curr_scan, mask=mask, dtype=dtype,
+                                          is_surface=surface)
+
+        keep = fdata.std(-1) >= std_tol_max
+        z_fdata = zscore_ts(fdata[keep])
+
+        return z_fdata, keep
+
+    if cache_dir is None:
+        return preprocess_scan(mask)
+
+    key = cache.cache_key(curr_scan, cache_dir,
+                          step='filtered_scan',
+                          surface=surface,
+                          null_labels=sorted(null_labels),
+                          dtype=np.dtype(dtype).str,
+                          std_tol_max=std_tol_max)
+    z_fdata, keep = cache.get_or_compute(cache_dir, key, lambda: preprocess_scan(None),
+                                         n_arrays=2)
+    if mask is None:
+        return z_fdata, keep
+
+    # rows of the cached voxels inside the mask, and the kept voxels among the in-mask
+    # voxels
+    mask = np.asarray(mask, dtype=bool).ravel()
+    return z_fdata[mask[keep]], keep[mask]
+
+def score_scan(curr_scan, surface, null_labels, parcel_indices, mask=None,
+               cache_dir=None):
+    '''
+    Computes FC homogeneity of one scan for each parcellation label index in
+    `parcel_indices`, whose voxel indices refer to the voxels in `mask`
+    '''
+    z_fdata, keep = load_filtered_scan(curr_scan, surface, null_labels, mask=mask,
+                                       cache_dir=cache_dir)
+    return [fc_homogeneity_from_index(utils.filter_parcel_index(parcel_index, keep),
+                                      z_fdata)
+            for parcel_index in parcel_indices]
+
+def _score_scan_from_shared(curr_scan, surface, null_labels, shared_parcel_indices,
+                            shared_mask, cache_dir):
+    # worker side of `run_fc_homogeneity_many`: label indices are memory-mapped instead of
+    # pickled
+    parcel_indices = [tuple(utils.load_shared_array(filename) for filename in filenames)
+                      for filenames in shared_parcel_indices]
+    return score_scan(curr_scan, surface, null_labels, parcel_indices,
+                      utils.load_shared_array(shared_mask), cache_dir)
+
+def run_fc_homogeneity_many(scans, parc_names, parc_fdatas, csv_filenames, surface,
+                            null_labels=(), n_jobs=1, cache_dir=None):
+    '''
+    Computes FC homogeneity of several parcellations, loading and filtering each scan only
+    once.
+
+    Parameters
+    -------
+    scans : array_like
+        List of filepaths as str to scans
+    parc_names : array_like
+        List of parcellation names as str
+    parc_fdatas : array_like
+        List of parcellation arrays on the grid of the scans, in the order of `parc_names`
+    csv_filenames : array_like
+        List of output filenames, one per parcellation. Each must end in `.csv`
+    surface : bool
+        If true, scans are loaded as surface data
+    n_jobs (optional) : int
+        Number of worker processes scans are spread over (-1 to use all cores).
+        Parcellations are shared with the workers as read-only memory-mapped files.
+    cache_dir (optional) : str
+        Directory of the on-disk cache of preprocessed scans (see `load_filtered_scan`),
+        shared by runs over any set of parcellations. A miss loads the whole scan. If
+        None, scans are not cached
+
+    Returns
+    -------
+    array_like
+        List of dataframes (same as `run_fc_homogeneity_from_dir` output), one per
+        parcellation
+    '''
+    # only voxels inside at least one parcellation are loaded
+    mask = np.any([np.ravel(parc_fdata) != 0 for parc_fdata in parc_fdatas], axis=0)
+    parcel_indices = [utils.build_parcel_index(np.ravel(parc_fdata)[mask])
+                      for parc_fdata in parc_fdatas]
+    all_fchs_df = [{'parcellation': [], 'subject': [], 'session': [], 'fchs': [],
+                    'all_fchs': []} for _ in parc_names]
+
+    with contextlib.ExitStack() as stack:
+        if n_jobs == 1:
+            all_scan_scores = map(score_scan, scans, repeat(surface), repeat(null_labels),
+                                  repeat(parcel_indices), repeat(mask), repeat(cache_dir))
         else:
-            _, fdata = utils.load_data(curr_scan, is_surface=False, null_labels = null_labels)
-
-        scan_split = str(curr_scan[0]).split("/")[-1].split("_")
-        
-        print(f'Computing functional connectivity homogeneity for scan {i}')
-        
-        filtered_fdata = utils.filter_ts_by_std(fdata, fdata, 1e-5)
-        atlas_filtered_fdata = utils.filter_ts_by_std(parc_fdata, fdata, 1e-5)
-        
-        # avg_fch, subj_fch = calc_fc_homogeneity(atlas_filtered_fdata, filtered_fdata, null_labels)
-
-        avg_fch, subj_fch = calc_fc_homogeneity(atlas_filtered_fdata, filtered_fdata)
-
-        # for BIDS-formatted data, concatenate to subject and session
-        fchs_df['parcellation'].append(parc_name)
-        fchs_df['subject'].append(scan_split[0])
-        fchs_df['session'].append(1)
-        fchs_df['fchs'].append(avg_fch)
-        fchs_df['all_fchs'].append([subj_fch])
-
-    fchs_df = pd.DataFrame.from_dict(fchs_df)
-    
-    fchs_df.to_csv(csv_filename, sep=',')
-    
+            shared_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            shared_parcel_indices = [[utils.save_shared_array(array, shared_dir)
+                                      for array in parcel_index]
+                                     for parcel_index in parcel_indices]
+            shared_mask = utils.save_shared_array(mask, shared_dir)
+            executor = stack.enter_context(
+                ProcessPoolExecutor(max_workers = utils.get_n_jobs(n_jobs)))
+            # map returns results in the order of scans
+            all_scan_scores = executor.map(_score_scan_from_shared, scans,
+                                           repeat(surface), repeat(null_labels),
+                                           repeat(shared_parcel_indices),
+                                           repeat(shared_mask), repeat(cache_dir))
+
+        for i, (curr_scan, scan_scores) in enumerate(zip(scans, all_scan_scores)):
+            scan_split = str(curr_scan[0]).split("/")[-1].split("_")
+
+            print(f'Computing functional connectivity homogeneity for scan {i}')
+
+            for parc_name, (avg_fch, subj_fch), fchs_df in zip(parc_names, scan_scores,
+                                                               all_fchs_df):
+                # for BIDS-formatted data, concatenate to subject and session
+                fchs_df['parcellation'].append(parc_name)
+                fchs_df['subject'].append(scan_split[0])
+                fchs_df['session'].append(1)
+                fchs_df['fchs'].append(avg_fch)
+                fchs_df['all_fchs'].append([subj_fch])
+
+    all_fchs_df = [pd.DataFrame.from_dict(fchs_df) for fchs_df in all_fchs_df]
+
+    for fchs_df, csv_filename in zip(all_fchs_df, csv_filenames):
+        fchs_df.to_csv(csv_filename, sep=',')
+
+    return all_fchs_df
+
+def run_fc_homogeneity_from_dir(scans, parc_name, parc_fdata, csv_filename, surface,
+                                null_labels=(), n_jobs=1, cache_dir=None):
+    fchs_df, = run_fc_homogeneity_many(scans, [parc_name], [parc_fdata], [csv_filename],
+                                       surface, null_labels, n_jobs, cache_dir)
     return fchs_df
 
-def average_fc_homogeneity(scans, parc_name, parc_fdata, csv_filename, surface, null_labels=()):
-    fchs_df = run_fc_homogeneity_from_dir(scans, parc_name, parc_fdata, csv_filename, surface, null_labels)
+def average_fchs_df(fchs_df):
+    '''
+    Averages the output of `run_fc_homogeneity_from_dir` across scans
+    '''
+    return fchs_df.groupby(['parcellation'])[['fchs']].mean()
+
+def average_fc_homogeneity(scans, parc_name, parc_fdata, csv_filename, surface,
+                           null_labels=(), n_jobs=1, cache_dir=None):
+    fchs_df = run_fc_homogeneity_from_dir(scans, parc_name, parc_fdata, csv_filename,
+                                          surface, null_labels, n_jobs, cache_dir)
 
-    avg_fc_homogeneity = fchs_df.groupby(['parcellation']).mean()
+    avg_fc_homogeneity = average_fchs_df(fchs_df)
 
-    return avg_fc_homogeneity
\ No newline at end of file
+    return avg_fc_homogeneity
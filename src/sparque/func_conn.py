@@ -1,9 +1,29 @@
-import numpy as np 
+import contextlib
 import os
-import pandas as pd 
-import nibabel as nb 
-from nilearn.maskers import NiftiLabelsMasker
-import sparque.utils as utils 
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import nibabel as nb
+import numpy as np
+import pandas as pd
+from nilearn import signal
+from nilearn.image import resample_img
+from scipy import sparse
+
+import sparque.cache as cache
+import sparque.conn_store as conn_store
+import sparque.ts_store as ts_store
+import sparque.utils as utils
+
+# label extractors already compiled in this process, keyed by (parcellation file, affine,
+# shape)
+_label_extractors = {}
+# stacked label extractors of lists of parcellations, keyed by (parcellation files,
+# affine, shape)
+_stacked_label_extractors = {}
+# sparse averaging operators of surface parcellations already loaded in this process,
+# keyed by file
+_surface_operators = {}
 
 def subset_confounds(confounds, confounds_list, subset_confounds_dir_name):
     '''
@@ -25,7 +45,192 @@ def subset_confounds(confounds, confounds_list, subset_confounds_dir_name):
         curr_counfounds_subset = curr_confounds[confounds_list]
         curr_counfounds_subset.to_csv(f'{subset_confounds_dir_name}/{confound_filename}', sep='\t', index = False)
 
-def run_connectivity(parcellation_file, data, confounds = None):
+class LabelExtractor:
+    '''
+    Parcel time series extractor compiled once for the grid (affine and shape) of a set of
+    scans. The parcellation is resampled to the grid (nearest neighbour) and turned into a
+    sparse averaging operator (see `utils.label_operator`), so each scan is transformed
+    with one sparse product instead of fitting a new `NiftiLabelsMasker`. Output matches
+    `NiftiLabelsMasker(labels_img=parcellation_file, standardize=True)`.
+
+    Parameters
+    -------
+    parcellation_file : str
+        Filepath to parcellation file
+    target_affine : array_like
+        Affine of the scans
+    target_shape : tuple
+        Spatial shape of the scans
+    cache_dir (optional) : str
+        Directory of an on-disk cache (see `cache.py`) keeping the resampled parcellation,
+        so other processes and reruns skip resampling. If None, nothing is cached
+    '''
+    def __init__(self, parcellation_file, target_affine, target_shape, cache_dir = None):
+        self.parcellation_file = parcellation_file
+        self.target_affine = np.asarray(target_affine)
+        self.target_shape = tuple(int(n) for n in target_shape)
+
+        if isinstance(parcellation_file, (str, os.PathLike)):
+            key = cache.cache_key(parcellation_file, cache_dir, step = 'label_extractor',
+                                  affine = self.target_affine.tolist(),
+                                  shape = self.target_shape)
+        else:
+            key, cache_dir = None, None
+        labels, = cache.get_or_compute(cache_dir, key, self._resample_labels)
+
+        self.parcels, self.mask, self.operator = utils.label_operator(labels)
+
+    @classmethod
+    def from_scan(cls, parcellation_file, data, cache_dir = None):
+        '''
+        Compiles an extractor for the grid of a scan, reading only its header
+        '''
+        loaded_data = nb.load(data)
+        return cls(parcellation_file, loaded_data.affine, loaded_data.shape[:3],
+                   cache_dir)
+
+    def _resample_labels(self):
+        atlas_resampled = resample_img(img = self.parcellation_file,
+                                       target_affine = self.target_affine,
+                                       target_shape = self.target_shape,
+                                       interpolation = 'nearest')
+        return (np.asarray(atlas_resampled.dataobj).astype(np.int32).ravel(),)
+
+    def transform(self, data, confounds = None, cache_dir = None):
+        '''
+        Computes the parcellated time series of a scan on the grid of the extractor
+
+        Parameters
+        -------
+        data : str
+            Filepath to scan
+        confounds (optional) : str or array_like
+            Confounds regressed out of the parcel time series, as accepted by
+            `nilearn.signal.clean`
+        cache_dir (optional) : str
+            Directory of an on-disk cache (see `cache.py`) keeping the in-brain voxels of
+            the scan, shared by every parcellation, so reruns skip decompressing it. A
+            miss loads the whole scan. If None, nothing is cached
+
+        Returns
+        -------
+        time_series : array_like
+            Standardized parcel time series, shape (time, parcels)
+        '''
+        return _extract_time_series(self, data, confounds, cache_dir)
+
+class StackedLabelExtractor:
+    '''
+    Extracts the parcel time series of several parcellations compiled for the same grid
+    (see `LabelExtractor`) from one read of a scan. The voxels of all parcellations are
+    loaded once, and their averaging operators are stacked, with columns remapped to the
+    union of their voxels, into one sparse product.
+
+    Parameters
+    -------
+    extractors : array_like
+        List of `LabelExtractor` objects compiled for the same affine and shape
+    '''
+    def __init__(self, extractors):
+        self.extractors = list(extractors)
+        self.target_affine = self.extractors[0].target_affine
+        self.target_shape = self.extractors[0].target_shape
+        for extractor in self.extractors:
+            if (extractor.target_shape != self.target_shape
+                    or not np.allclose(extractor.target_affine, self.target_affine)):
+                raise ValueError('label extractors were compiled for different grids')
+
+        self.mask = np.any([extractor.mask for extractor in self.extractors], axis = 0)
+        union_position = np.cumsum(self.mask) - 1
+
+        operators = []
+        for extractor in self.extractors:
+            operator = extractor.operator.tocoo()
+            columns = union_position[np.flatnonzero(extractor.mask)][operator.col]
+            operators += [sparse.csr_matrix((operator.data, (operator.row, columns)),
+                                            shape = (operator.shape[0],
+                                                     union_position[-1] + 1))]
+        self.operator = sparse.vstack(operators, format = 'csr')
+
+        # time series of extractors[i] are columns offsets[i]:offsets[i + 1] of the
+        # stacked time series
+        self.offsets = np.cumsum([0] + [extractor.parcels.size
+                                        for extractor in self.extractors])
+
+    def transform(self, data, confounds = None, cache_dir = None):
+        '''
+        Computes the parcellated time series of a scan for every parcellation (see
+        `LabelExtractor.transform`). Cleaning acts on each parcel time series separately,
+        so cleaning the stacked time series at once gives the same output as each
+        extractor.
+
+        Returns
+        -------
+        all_time_series : array_like
+            List of standardized parcel time series, shape (time, parcels), one per
+            extractor
+        '''
+        time_series = _extract_time_series(self, data, confounds, cache_dir)
+        return [time_series[:, start:stop]
+                for start, stop in zip(self.offsets[:-1], self.offsets[1:])]
+
+def _load_brain_voxels(data):
+    # voxels that are 0 at every time point (outside the brain) add nothing to a parcel
+    # mean, so only the others are kept
+    _, fdata = utils.load_masked_data(data)
+    in_brain = np.any(fdata != 0, axis = 1)
+    return fdata[in_brain], in_brain
+
+def _extract_time_series(extractor, data, confounds, cache_dir = None):
+    loaded_data = nb.load(data)
+    if (loaded_data.shape[:3] != extractor.target_shape
+            or not np.allclose(loaded_data.affine, extractor.target_affine)):
+        raise ValueError(f'{data} is not on the grid the label extractor was compiled '
+                         'for')
+
+    if cache_dir is None:
+        _, fdata = utils.load_masked_data(data, extractor.mask)
+        operator = extractor.operator
+    else:
+        # the entry does not depend on the parcellations, so every extractor shares it
+        key = cache.cache_key(data, cache_dir, step = 'brain_voxels',
+                              dtype = np.dtype(np.float32).str)
+        fdata, in_brain = cache.get_or_compute(
+            cache_dir, key, lambda: _load_brain_voxels(data), n_arrays = 2)
+
+        # remap the columns of the operator to the rows of the cached voxels, which are
+        # read from the memory-mapped entry by the product
+        is_cached = in_brain[extractor.mask]
+        operator = extractor.operator[:, is_cached].tocoo()
+        brain_position = np.cumsum(in_brain) - 1
+        columns = brain_position[np.flatnonzero(extractor.mask & in_brain)][operator.col]
+        operator = sparse.csr_matrix((operator.data, (operator.row, columns)),
+                                     shape = (operator.shape[0], fdata.shape[0]))
+
+    time_series = np.asarray(operator @ fdata, dtype = np.float64).T
+    return signal.clean(time_series,
+                        detrend = False,
+                        standardize = True,
+                        standardize_confounds = True,
+                        confounds = confounds)
+
+def get_label_extractor(parcellation_file, data, cache_dir = None):
+    '''
+    Returns the label extractor of a parcellation for the grid of a scan, compiling it
+    only the first time the grid is seen in this process
+    '''
+    loaded_data = nb.load(data)
+    if not isinstance(parcellation_file, (str, os.PathLike)):
+        return LabelExtractor(parcellation_file, loaded_data.affine,
+                              loaded_data.shape[:3])
+
+    key = (parcellation_file, loaded_data.affine.tobytes(), loaded_data.shape[:3])
+    if key not in _label_extractors:
+        _label_extractors[key] = LabelExtractor(parcellation_file, loaded_data.affine,
+                                                loaded_data.shape[:3], cache_dir)
+    return _label_extractors[key]
+
+def run_connectivity(parcellation_file, data, confounds = None, cache_dir = None):
     '''
     Computes parcelwise connectivity matrix
 
@@ -37,6 +242,9 @@ def run_connectivity(parcellation_file, data, confounds = None):
         Filepath to image to compute parcelwise connectiviy matrix
     confounds : str
         Filepath to associated confound file
+    cache_dir (optional) : str
+        Directory of an on-disk cache of resampled parcellations (see `LabelExtractor`)
+        and in-brain scan voxels (see `LabelExtractor.transform`)
     
     Returns
     -------
@@ -45,42 +253,77 @@ def run_connectivity(parcellation_file, data, confounds = None):
     connectivity : array_like
         parcelwise connectivy matrix
     '''
-    masker = NiftiLabelsMasker(
-        labels_img=parcellation_file,
-        standardize=True,
-        memory='nilearn_cache',
-        verbose=5,
-    )
-
-    if confounds is None:
-        time_series = masker.fit_transform(data)
-    else:
-        time_series = masker.fit_transform(
-            data,
-            confounds = confounds
-        )
+    extractor = get_label_extractor(parcellation_file, data, cache_dir)
+    time_series = extractor.transform(data, confounds, cache_dir)
 
     connectivity = np.corrcoef(time_series.T)
 
     return time_series, connectivity
 
+def run_connectivity_many(parcellation_files, data, confounds = None, cache_dir = None):
+    '''
+    Computes parcelwise connectivity matrices of several parcellations from one read of a
+    scan (see `StackedLabelExtractor`). Output is the same as `run_connectivity` for each
+    parcellation.
+
+    Parameters
+    -------
+    parcellation_files : array_like
+        List of filepaths to parcellation files
+    data : str
+        Filepath to image to compute parcelwise connectiviy matrices
+    confounds : str
+        Filepath to associated confound file
+    cache_dir (optional) : str
+        Directory of an on-disk cache of resampled parcellations (see `LabelExtractor`)
+        and in-brain scan voxels (see `LabelExtractor.transform`)
+
+    Returns
+    -------
+    array_like
+        List of (parcellated time series, parcelwise connectivy matrix), one per
+        parcellation
+    '''
+    loaded_data = nb.load(data)
+    key = (tuple(parcellation_files), loaded_data.affine.tobytes(), loaded_data.shape[:3])
+    if key not in _stacked_label_extractors:
+        _stacked_label_extractors[key] = StackedLabelExtractor(
+            [get_label_extractor(parcellation_file, data, cache_dir)
+             for parcellation_file in parcellation_files])
+
+    all_time_series = _stacked_label_extractors[key].transform(data, confounds, cache_dir)
+
+    return [(time_series, np.corrcoef(time_series.T)) for time_series in all_time_series]
+
+def get_surface_operator(parcellation_file):
+    '''
+    Returns the sparse averaging operator of a surface parcellation file (see
+    `utils.label_operator`), built only the first time the file is seen in this process.
+    Labels 0 and the last label (medial wall) are left out.
+    '''
+    if parcellation_file not in _surface_operators:
+        _, labels = utils.load_data(parcellation_file, is_parcellation=True,
+                                    is_surface = True, null_labels = [0,-1])
+        _surface_operators[parcellation_file] = utils.label_operator(labels)
+    return _surface_operators[parcellation_file]
+
 def run_connectivity_surface(parcellation_file, data):
     '''
-    Computes parcelwise connectivity matrix for surface data
+    Computes parcelwise connectivity matrix for surface data. Parcel time series are the
+    means of the float32 vertex time series of each parcel, one row per parcel of the left
+    then the right hemisphere.
     '''
     parcellation = dict(zip(('L', 'R'), parcellation_file))
     data = dict(zip(('L', 'R'), data))
     data_lab = dict()
     for hemi in ['L', 'R']:
-        _,labels = utils.load_data(parcellation[hemi], is_parcellation=True, is_surface = True, null_labels = [0,-1])
-        # labels = nb.load(parcellation[hemi]).darrays[0].data.astype(int)
-        lab_map = np.eye(labels.max() + 1)[labels]
-        data_unlab = np.stack([arr.data for arr in nb.load(data[hemi]).darrays])
-        data_lab[hemi] = lab_map.T @ data_unlab.T
-    # assert 0
-    print('time series shape', np.vstack([data_lab['L'], data_lab['R']]).shape)
-    # print('time series shape', np.corrcoef(np.vstack([data_lab['L'], data_lab['R']]).T).shape)
-    return np.vstack([data_lab['L'], data_lab['R']]), np.corrcoef(np.vstack([data_lab['L'], data_lab['R']]).squeeze())
+        _, mask, operator = get_surface_operator(parcellation[hemi])
+        _, data_unlab = utils.load_masked_data(data[hemi], mask, is_surface = True)
+        data_lab[hemi] = operator @ data_unlab
+
+    time_series = np.vstack([data_lab['L'], data_lab['R']])
+    print('time series shape', time_series.shape)
+    return time_series, np.corrcoef(time_series)
 
 def get_uniq_conn_vals(conn_mat):
     '''
@@ -88,9 +331,74 @@ def get_uniq_conn_vals(conn_mat):
     '''
     return conn_mat[np.triu_indices_from(conn_mat, 1)]
 
-def conn_from_dir(parc_name, parcellation_file, scans, confounds_subdir = None, output_name = None):   
+def conn_rows_to_df(subjects, sessions, edges, labels = None):
+    '''
+    Builds the dataframe of edge lists returned by `conn_from_dir` in one step: subject
+    and session columns, one float32 column per edge (named from 2 on), and a label column
+    (subjects by default)
+    '''
+    conn_df = pd.DataFrame(edges, columns = range(2, edges.shape[1] + 2), copy = False)
+    conn_df.insert(0, 'session', sessions)
+    conn_df.insert(0, 'subject', subjects)
+    conn_df['label'] = subjects if labels is None else labels
+    return conn_df
+
+def scan_conn(parcellation_files, curr_scan, confounds_subdir = None, cache_dir = None):
+    '''
+    Computes the parcellated time series and edge lists of a single scan for several
+    parcellations (used in `conn_from_dir_many()`). Volume scans are read once for all
+    parcellations (see `run_connectivity_many`).
+
+    Returns
+    -------
+    subject : str
+        Subject of the scan
+    session : str
+        Session of the scan
+    all_time_series : array_like
+        List of parcellated time series, one per parcellation
+    all_conn_uq : array_like
+        List of float32 edge lists of the parcelwise connectivity matrices, one per
+        parcellation
+    '''
+    if isinstance(curr_scan, tuple):
+        # TO DO LATER: incorporate session info
+        subj_ses_info = curr_scan[0].split("/")[-1].split("_")
+        subject, session = subj_ses_info[0], 1
+        print('Currently computing connectivity based on surface data for '
+              f'{subj_ses_info[0]}')
+        all_conns = [run_connectivity_surface(parcellation_file, curr_scan)
+                     for parcellation_file in parcellation_files]
+    else:
+        scan_split = str(curr_scan).split("/")[-1].split("_")
+
+        if confounds_subdir is not None:
+            confound_file = (f'{confounds_subdir}/{scan_split[0]}_{scan_split[1]}'
+                             f'_task-rest_{scan_split[3]}_desc-confounds_timeseries.tsv')
+        else:
+            confound_file = None
+
+        print(f'Currently computing for {scan_split[0]}, {scan_split[1]} with confound '
+              f'file {confound_file}')
+
+        subject, session = scan_split[0], scan_split[1]
+        all_conns = run_connectivity_many(parcellation_files, curr_scan, confound_file,
+                                          cache_dir)
+
+    all_time_series = [curr_time_series for curr_time_series, _ in all_conns]
+    all_conn_uq = [get_uniq_conn_vals(curr_conn_mat).astype(np.float32)
+                   for _, curr_conn_mat in all_conns]
+    return subject, session, all_time_series, all_conn_uq
+
+def conn_from_dir(parc_name, parcellation_file, scans, confounds_subdir = None,
+                  output_name = None, n_jobs = 1, max_worker_memory = None,
+                  cache_dir = None):
     '''
-    Run connectivity for multiple scans and saves parcellated time series in `.h5` file for each parcellation. By default, this function will create a label column with subjects as label. **NOTE: only scan names with format 'sub-{subject name}_ses-{session number}_task-rest_{run}' currently supported. 
+    Run connectivity for multiple scans and saves parcellated time series in
+    `{parc_name}_time_series.h5` for each parcellation, written one session at a time (see
+    `ts_store.py`). By default, this function will create a label column with subjects as
+    label. **NOTE: only scan names with format 'sub-{subject name}_ses-{session
+    number}_task-rest_{run}' currently supported.
 
     Parameters
     -------
@@ -103,71 +411,109 @@ def conn_from_dir(parc_name, parcellation_file, scans, confounds_subdir = None,
     confounds_subdir : str
         Path to associated confounds directory
     output_name (optional) : str
-        If saving functional connectivity file, return 
+        If saving functional connectivity file, directory of the connectome store to write
+        it to (see `conn_store.py`), or filename of a `.csv` if it ends in `.csv`
+    n_jobs (optional) : int
+        Number of worker processes used to spread scans over (-1 to use all cores). Rows
+        of the output keep the order of `scans`
+    max_worker_memory (optional) : int
+        Address space limit of each worker process in bytes (see `utils.limit_memory`), so
+        that a few large scans fail with a MemoryError instead of exhausting the machine.
+        Only used if `n_jobs` is not 1
+    cache_dir (optional) : str
+        Directory of an on-disk cache of resampled parcellations (see `LabelExtractor`)
+        and in-brain scan voxels (see `LabelExtractor.transform`), shared by worker
+        processes. Reruns on the same scans skip reading them again
     
     Returns
     -------
     conn_df : dataframe 
         Dataframe containing edge list of parcelwise connectivty matrix for each subject and session
     ''' 
-    conn_df = pd.DataFrame()
-    subjects = []
-    sessions = []
+    return conn_from_dir_many([parc_name], [parcellation_file], scans, confounds_subdir,
+                              [output_name], n_jobs, max_worker_memory, cache_dir)[0]
 
-    time_series_df = {'subject': [], 'session': [], 'time_series': []}
-
-    for curr_scan in scans:
-        if isinstance(curr_scan, tuple):
-            # TO DO LATER: incorporate session info
-            subj_ses_info = curr_scan[0].split("/")[-1].split("_")
-            subjects += [subj_ses_info[0]]
-            sessions += [1]
-            print(f'Currently computing connectivity based on surface data for {subj_ses_info[0]}')
-            time_series_df['subject'].append(subj_ses_info[0])
-            time_series_df['session'].append(1)
-            curr_time_series, curr_conn_mat = run_connectivity_surface(parcellation_file, curr_scan)
-        else:
-            scan_split = str(curr_scan).split("/")[-1].split("_")
+def conn_from_dir_many(parc_names, parcellation_files, scans, confounds_subdir = None,
+                       output_names = None, n_jobs = 1, max_worker_memory = None,
+                       cache_dir = None):
+    '''
+    Same as `conn_from_dir` for several parcellations at once, reading each scan once for
+    all of them (see `run_connectivity_many`). Outputs of each parcellation are the same
+    as running `conn_from_dir` on it.
 
-            if confounds_subdir is not None:
-                confound_file = f'{confounds_subdir}/{scan_split[0]}_{scan_split[1]}_task-rest_{scan_split[3]}_desc-confounds_timeseries.tsv'
-            else:
-                confound_file = None 
+    Parameters
+    -------
+    parc_names : array_like
+        List of parcellation names
+    parcellation_files : array_like
+        List of filepaths to parcellation files or tuples of left and right parcellation
+        files
+    output_names (optional) : array_like
+        List of output names (see `conn_from_dir`), one per parcellation. If None, nothing
+        is exported
 
-            print(f'Currently computing for {scan_split[0]}, {scan_split[1]} with confound file {confound_file}')
+    See `conn_from_dir` for the other parameters.
 
-            subjects += [scan_split[0]]
-            sessions += [scan_split[1]]
+    Returns
+    -------
+    array_like
+        List of dataframes (same as `conn_from_dir` output), one per parcellation
+    '''
+    if output_names is None:
+        output_names = [None] * len(parc_names)
 
-            time_series_df['subject'].append(scan_split[0])
-            time_series_df['session'].append(scan_split[1])
+    subjects = []
+    sessions = []
+    # edge lists of all scans per parcellation, allocated once the number of edges is
+    # known from the first scan
+    all_edges = None
 
-            curr_time_series, curr_conn_mat = run_connectivity(parcellation_file, curr_scan, confound_file)
+    with contextlib.ExitStack() as stack:
+        # time series are written as they arrive instead of being kept until the end
+        time_series_stores = []
+        for parc_name in parc_names:
+            time_series_filename = f'{parc_name}_time_series.h5'
+            time_series_stores += [stack.enter_context(
+                ts_store.open_time_series_store(time_series_filename, mode = 'w'))]
 
-        time_series_df['time_series'].append(curr_time_series)
-        
-        curr_conn_uq = get_uniq_conn_vals(curr_conn_mat)
-        subj_ses = np.array([subjects[-1], sessions[-1]])
-        # subj_ses = np.array([scan_split[0], scan_split[1]])
+        if n_jobs == 1:
+            all_scan_conns = map(scan_conn, repeat(parcellation_files), scans,
+                                 repeat(confounds_subdir), repeat(cache_dir))
+        else:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(max_workers = utils.get_n_jobs(n_jobs),
+                                    initializer = utils.limit_memory,
+                                    initargs = (max_worker_memory,)))
+            # map returns results in the order of scans
+            all_scan_conns = executor.map(scan_conn, repeat(parcellation_files), scans,
+                                          repeat(confounds_subdir), repeat(cache_dir))
 
-        curr_data = np.concatenate((subj_ses, curr_conn_uq))
-        curr_data_df = pd.DataFrame(data = curr_data)
+        for i, (subject, session, all_time_series, all_conn_uq) in enumerate(
+                all_scan_conns):
+            subjects += [subject]
+            sessions += [session]
 
-        curr_data_df = curr_data_df.T
+            if all_edges is None:
+                all_edges = [np.empty((len(scans), curr_conn_uq.size), dtype = np.float32)
+                             for curr_conn_uq in all_conn_uq]
 
-        conn_df = pd.concat([conn_df, curr_data_df], axis = 0)
+            for time_series_store, edges, curr_time_series, curr_conn_uq in zip(
+                    time_series_stores, all_edges, all_time_series, all_conn_uq):
+                ts_store.append_time_series(time_series_store, subject, session,
+                                            curr_time_series)
+                edges[i] = curr_conn_uq
 
-    conn_df.rename(columns={0: 'subject', 1: 'session'}, inplace=True)
-    conn_df['label'] = conn_df['subject']
+    all_conn_df = []
+    for output_name, edges in zip(output_names, all_edges):
+        conn_df = conn_rows_to_df(subjects, sessions, edges)
 
-    if output_name is None:
-        print('functional connectivity file not exported')
-    else:
-        conn_df.to_csv(output_name, sep=',')
+        if output_name is None:
+            print('functional connectivity file not exported')
+        elif str(output_name).endswith('.csv'):
+            conn_df.to_csv(output_name, sep=',')
+        else:
+            conn_store.write_conn_store(output_name, subjects, sessions, edges)
 
-    time_series_df = pd.DataFrame.from_dict(time_series_df)
-    time_series_store = pd.HDFStore(f'{parc_name}_time_series.h5')
-    time_series_store['df'] = time_series_df
-    time_series_store.close()
+        all_conn_df += [conn_df]
 
-    return conn_df
\ No newline at end of file
+    return all_conn_df
@@ -1,7 +1,11 @@
-import pandas as pd
-import numpy as np
 from datetime import datetime
 
+import numpy as np
+import pandas as pd
+
+import sparque.conn_store as conn_store
+
+
 def calc_reliability(subj_name, df, subj_column_name, func_conn_col_start=3):
     """
     Calculate reliability of parcellated connectome across runs for a single subject.
@@ -34,7 +38,64 @@ def calc_reliability(subj_name, df, subj_column_name, func_conn_col_start=3):
 
     return corr_conn[np.triu_indices_from(corr_conn, 1)]
 
-def reliability_multiple_subjects(df, subj_column_name, output_filename, func_conn_col_start=3):
+def normalize_z_edges(z_edges):
+    """
+    Fisher z-transforms, mean-centers and normalizes each session (row) of a float32 edge
+    array in place, so that the correlation between two sessions is the dot product of
+    their rows
+    """
+    np.arctanh(z_edges, out = z_edges)
+    z_edges -= z_edges.mean(axis = 1, keepdims = True)
+    z_edges /= np.linalg.norm(z_edges, axis = 1, keepdims = True)
+    return z_edges
+
+def reliability_from_edges(subjects, edges):
+    """
+    Calculate reliability of parcellated connectome across runs for all subjects at once.
+
+    Sessions are sorted by subject into one contiguous float32 array, Fisher z-transformed
+    in place and mean-centered and normalized per session, so the reliabilities of each
+    subject are the upper triangle of a single matrix product of its block of sessions.
+    See documentation of `calc_reliability` for more information on reliability.
+
+    Parameters
+    ----------
+    subjects : array_like
+        Subject of each session, shape (sessions,)
+    edges : array_like
+        Edge lists of the connectivity matrices of each session, shape (sessions, edges).
+        Not modified, so it can be a read-only memory map
+
+    Returns
+    -------
+    array_like
+        Sorted unique subjects
+    array_like
+        List of upper triangles of matrices of reliabilities across pairs of runs, one per
+        subject
+    """
+    subjects = np.asarray(subjects)
+    order = np.argsort(subjects, kind = 'stable')
+    unique_subjects, subject_starts = np.unique(subjects[order], return_index = True)
+
+    z_edges = normalize_z_edges(np.asarray(edges, dtype = np.float32)[order])
+
+    subject_stops = np.append(subject_starts[1:], len(subjects))
+
+    all_reliabilities = []
+    for start, stop in zip(subject_starts, subject_stops):
+        if stop - start < 2:
+            raise Exception('Could not compute reliabilities across sessions. This could '
+                            'be due to at least one of your subjects having only one '
+                            'session or one of your connectivity values is not valid.')
+        corr_conn = z_edges[start:stop] @ z_edges[start:stop].T
+        reliabilities = corr_conn[np.triu_indices_from(corr_conn, 1)]
+        all_reliabilities.append(reliabilities.astype(np.float64))
+
+    return unique_subjects, all_reliabilities
+
+def reliability_multiple_subjects(df, subj_column_name, output_filename,
+                                  func_conn_col_start=3, incremental=False):
     """
     Calculate reliability of parcellated connectome across runs for multiple subjects. Sessions with nan values in edge lists are dropped and recorded in `reliability_log_{current date and time}.txt`
 
@@ -42,20 +103,36 @@ def reliability_multiple_subjects(df, subj_column_name, output_filename, func_co
 
     Parameters
     ----------
-    df : dataframe object
-        Dataframe of subjects, sessions, and edge lists of connectivity matrices across runs (currently expected output from `func_conn.conn_from_dir`) 
+    df : dataframe object or str
+        Dataframe of subjects, sessions, and edge lists of connectivity matrices across
+        runs (currently expected output from `func_conn.conn_from_dir`), or directory of a
+        connectome store (see `conn_store.py`), whose edges are read through a memory map
     subj_column_name : str
         Column name that defines the subject; currently expecting 'subject'
     func_conn_col_start : int
-        Index of where the edge list values start. If output from `func_conn.conn_from_dir`, edge list values start at column 3. 
+        Index of where the edge list values start. If output from
+        `func_conn.conn_from_dir`, edge list values start at column 3. Not used for a
+        connectome store
     output_filename: str
         Output filename for reliabilities. Must end in `.h5`
+    incremental (optional) : bool
+        If true, `df` only holds new sessions, which are added to the reliabilities
+        already in `output_filename` (see `update_reliability`)
 
     Returns
     -------
     dataframe 
        Dataframe of subjects and corresponding matrices. This is saved in an `hf` file. 
     """
+    if conn_store.is_conn_store(df):
+        if not incremental:
+            return reliability_from_conn_store(df, subj_column_name, output_filename)
+        df = conn_store.conn_store_to_df(df).drop(columns = 'label')
+        func_conn_col_start = 2
+
+    if incremental:
+        return update_reliability(df, subj_column_name, output_filename,
+                                  func_conn_col_start)
 
     nan_df = df.isna().any(axis=1)
 
@@ -64,14 +141,32 @@ def reliability_multiple_subjects(df, subj_column_name, output_filename, func_co
 
     df = df.dropna(axis = 'rows')
     
-    subjects = df[subj_column_name]
+    edges = df.iloc[:,func_conn_col_start:].to_numpy(dtype = np.float32)
+    subjects = df[subj_column_name].to_numpy()
+    return _save_reliabilities(*reliability_from_edges(subjects, edges), output_filename)
+
+def reliability_from_conn_store(store_dir, subj_column_name, output_filename):
+    """
+    Calculate reliability of parcellated connectome across runs for multiple subjects from
+    a connectome store (see `conn_store.py`). Edges are read through a memory map, so the
+    only copy made is the float32 block normalized by `reliability_from_edges`. Sessions
+    with nan values in edge lists are dropped and recorded in
+    `reliability_log_{current date and time}.txt`
+    """
+    metadata, edges = conn_store.load_conn_store(store_dir)
+    nan_rows = np.isnan(edges).any(axis=1)
 
-    avg_corr_connmats = {'subject': [], 'reliabilities': []}
+    with open(f'reliability_log_{datetime.now()}.txt', 'w') as f:
+        f.write(f'rows dropped \n {metadata[nan_rows]}')
+
+    if nan_rows.any():
+        edges = edges[~nan_rows]
+    subjects = metadata[subj_column_name].to_numpy()[~nan_rows]
 
-    for _,subject in enumerate(np.unique(list(subjects))):
-        reliabilities = calc_reliability(subject, df, subj_column_name, func_conn_col_start)
-        avg_corr_connmats['subject'].append(subject)
-        avg_corr_connmats['reliabilities'].append(reliabilities)
+    return _save_reliabilities(*reliability_from_edges(subjects, edges), output_filename)
+
+def _save_reliabilities(subjects, all_reliabilities, output_filename):
+    avg_corr_connmats = {'subject': list(subjects), 'reliabilities': all_reliabilities}
 
     avg_corr_connmats_df = pd.DataFrame.from_dict(avg_corr_connmats)
     avg_corr_conmats_store = pd.HDFStore(output_filename)
@@ -80,6 +175,132 @@ def reliability_multiple_subjects(df, subj_column_name, output_filename, func_co
 
     return avg_corr_connmats_df
 
+def update_reliability(df, subj_column_name, output_filename, func_conn_col_start=3,
+                       session_column_name='session'):
+    """
+    Add new sessions to the reliabilities stored in `output_filename` without recomputing
+    the sessions already there. Sessions with nan values in edge lists are dropped and
+    recorded in `reliability_log_{current date and time}.txt`
+
+    Besides the `df` key (same as `reliability_multiple_subjects`), the store keeps the
+    normalized z-edge vectors of every session (see `normalize_z_edges`) under
+    `normalized/subject_{i}`, indexed by session, with the subject of each key in
+    `normalized_keys`. For a subject with new sessions, only the correlations of the new
+    sessions with each other and with the stored sessions are computed; other subjects are
+    not read. Sessions that are already stored are replaced rather than added again. If
+    the store does not exist yet, all sessions are new.
+
+    Parameters
+    ----------
+    df : dataframe object
+        Dataframe of subjects, sessions, and edge lists of connectivity matrices of the
+        new sessions (currently expected output from `func_conn.conn_from_dir`)
+    subj_column_name : str
+        Column name that defines the subject; currently expecting 'subject'
+    output_filename: str
+        Filename of the reliability store to update. Must end in `.h5`
+    func_conn_col_start : int
+        Index of where the edge list values start. If output from
+        `func_conn.conn_from_dir`, edge list values start at column 3.
+    session_column_name (optional) : str
+        Column name that defines the session (compared as str)
+
+    Returns
+    -------
+    dataframe
+       Dataframe of all subjects and corresponding matrices, as stored in the `df` key.
+       Subjects with a single session so far have no reliabilities yet
+    """
+    nan_df = df.isna().any(axis=1)
+
+    with open(f'reliability_log_{datetime.now()}.txt', 'w') as f:
+        f.write(f'rows dropped \n {df[nan_df]}')
+
+    df = df.dropna(axis = 'rows')
+
+    with pd.HDFStore(output_filename) as store:
+        if 'df' in store:
+            if 'normalized_keys' not in store:
+                raise Exception(f'{output_filename} does not contain normalized '
+                                'sessions. It was probably written by '
+                                '`reliability_multiple_subjects` without `incremental`, '
+                                'so it cannot be updated.')
+            avg_corr_connmats_df = store['df']
+            normalized_keys = store['normalized_keys']
+        else:
+            avg_corr_connmats_df = pd.DataFrame({'subject': [], 'reliabilities': []})
+            normalized_keys = pd.DataFrame({'subject': [], 'key': []})
+
+        subject_rows = dict(zip(avg_corr_connmats_df['subject'],
+                                range(len(avg_corr_connmats_df))))
+        subject_keys = dict(zip(normalized_keys['subject'], normalized_keys['key']))
+
+        all_reliabilities = list(avg_corr_connmats_df['reliabilities'])
+        all_subjects = list(avg_corr_connmats_df['subject'])
+
+        for subject, subject_df in df.groupby(subj_column_name, sort = True):
+            # a session passed twice in the batch keeps its last edges
+            session_names = subject_df[session_column_name].astype(str)
+            subject_df = subject_df[~session_names.duplicated(keep = 'last')]
+            new_sessions = subject_df[session_column_name].astype(str).to_numpy()
+            new_z_edges = normalize_z_edges(subject_df.iloc[:,func_conn_col_start:]
+                                            .to_numpy(dtype = np.float32, copy = True))
+
+            if subject in subject_keys:
+                old_z_edges_df = store[subject_keys[subject]]
+                old_sessions = old_z_edges_df.index.to_numpy()
+                n_old = len(old_sessions)
+
+                # sessions already stored are replaced in place, the others are appended
+                old_positions = dict(zip(old_sessions, range(n_old)))
+                is_stored = np.array([session in old_positions
+                                      for session in new_sessions], dtype = bool)
+                positions = np.array([old_positions.get(session, -1)
+                                      for session in new_sessions])
+                positions[~is_stored] = n_old + np.arange(np.count_nonzero(~is_stored))
+
+                sessions = np.concatenate([old_sessions, new_sessions[~is_stored]])
+                z_edges = np.concatenate([old_z_edges_df.to_numpy(),
+                                          new_z_edges[~is_stored]])
+                z_edges[positions] = new_z_edges
+
+                # rebuild the stored correlation matrix from its upper triangle
+                corr_conn = np.eye(len(sessions))
+                old_reliabilities = all_reliabilities[subject_rows[subject]]
+                corr_conn[np.triu_indices(n_old, 1)] = old_reliabilities
+                corr_conn = (np.triu(corr_conn, 1) + np.triu(corr_conn, 1).T
+                             + np.eye(len(sessions)))
+
+                # only correlations with the new sessions are computed
+                corr_conn[positions] = z_edges[positions] @ z_edges.T
+                corr_conn[:, positions] = corr_conn[positions].T
+            else:
+                subject_keys[subject] = f'normalized/subject_{len(subject_keys)}'
+                corr_conn = (new_z_edges @ new_z_edges.T).astype(np.float64)
+                sessions = new_sessions
+                z_edges = new_z_edges
+
+            reliabilities = corr_conn[np.triu_indices_from(corr_conn, 1)]
+            if subject in subject_rows:
+                all_reliabilities[subject_rows[subject]] = reliabilities
+            else:
+                subject_rows[subject] = len(all_subjects)
+                all_subjects.append(subject)
+                all_reliabilities.append(reliabilities)
+
+            store[subject_keys[subject]] = pd.DataFrame(
+                z_edges, index = pd.Index(sessions, name = 'session'))
+
+        order = np.argsort(all_subjects, kind = 'stable')
+        avg_corr_connmats_df = pd.DataFrame.from_dict(
+            {'subject': [all_subjects[i] for i in order],
+             'reliabilities': [all_reliabilities[i] for i in order]})
+        store['df'] = avg_corr_connmats_df
+        store['normalized_keys'] = pd.DataFrame.from_dict(
+            {'subject': list(subject_keys), 'key': list(subject_keys.values())})
+
+    return avg_corr_connmats_df
+
 def get_reliability(avg_corr_connmats_df):
     '''
     Returns the mean reliability across subjects
@@ -1,14 +1,17 @@
-import pandas as pd
 from datetime import datetime
+
 import nibabel as nb
 import numpy as np
+import pandas as pd
 
+import sparque.conn_store as conn_store
+import sparque.dcbc as dcbc
 import sparque.fc_homogeneity as fc_homogeneity
-import sparque.utils as utils
+import sparque.parcellation_dict as parcellation_dict
 import sparque.reliability as reliability
 import sparque.svc as svc
-import sparque.dcbc as dcbc
-import sparque.parcellation_dict as parcellation_dict
+import sparque.utils as utils
+
 
 def run_all_metrics(scans,  
                     metrics,
@@ -20,9 +23,15 @@ def run_all_metrics(scans,
                     reliability_conn_file = None,
                     func_conn_col_start = 3,
                     surface=False,
-                    null_labels = ()):
+                    null_labels = (),
+                    fchs_df = None,
+                    n_jobs = 1,
+                    cache_dir = None,
+                    DCBC_average_df = None):
     '''
-    Function to save metric outputs (used in `run_parcel_eval()`)
+    Function to save metric outputs (used in `run_parcel_eval()`). If `fchs_df` or
+    `DCBC_average_df` are given, FC homogeneity or DCBC are taken from them instead of
+    being recomputed.
     '''
 
     eval_data = {'parcellation': [parc_name]}
@@ -30,7 +39,12 @@ def run_all_metrics(scans,
     for _, curr_metric in enumerate(metrics):
         print(f'Computing {curr_metric}')
         if curr_metric == 'fc_homogeneity':
-            temp_eval_data_df = fc_homogeneity.average_fc_homogeneity(scans, parc_name, parc_fdata, f'{parc_name}_fch_{datetime.now()}.csv', surface, null_labels)
+            if fchs_df is None:
+                temp_eval_data_df = fc_homogeneity.average_fc_homogeneity(
+                    scans, parc_name, parc_fdata, f'{parc_name}_fch_{datetime.now()}.csv',
+                    surface, null_labels, n_jobs, cache_dir)
+            else:
+                temp_eval_data_df = fc_homogeneity.average_fchs_df(fchs_df)
 
             eval_data['fc_homogeneity'] = [temp_eval_data_df['fchs'].iloc[0]]
         
@@ -43,7 +57,10 @@ def run_all_metrics(scans,
             eval_data['reliability'] = np.mean(temp_eval_data_df['mean_reliability'])
             
         elif curr_metric == 'svc':
-            mean_acc, scores = svc.run_svc_with_shuffle_split(func_conn_file)
+            split_performance_df, _ = svc.run_svc_with_shuffle_split(func_conn_file,
+                                                                     n_jobs)
+            scores = list(split_performance_df['accuracy'])
+            mean_acc = np.mean(scores)
             temp_eval_dict = {'parcellation': [parc_name], 'svc': [scores], 'svc_mean_acc': [mean_acc]}
             temp_eval_data_df = pd.DataFrame.from_dict(temp_eval_dict)
 
@@ -54,15 +71,13 @@ def run_all_metrics(scans,
             eval_data['svc'] = [temp_eval_data_df['svc_mean_acc'].iloc[0]]
 
         elif curr_metric == 'dcbc':
-            _, DCBC_average_df = dcbc.run_DCBC(dist_file,
-                                              parc_name,
-                                              loaded_surface_parc,
-                                              run_mni_to_fslr32k = False, 
-                                              scan_directory = None,
-                                              convert_parcel_to_fslr32k = False,
-                                              save_parcel_gii = False, 
-                                              filename_gii = None,
-                                              csv_filename = f'{parc_name}_DCBC_{datetime.now()}.csv')
+            if DCBC_average_df is None:
+                _, DCBC_average_df = dcbc.run_DCBC(dist_file,
+                                                  parc_name,
+                                                  loaded_surface_parc,
+                                                  csv_filename = (f'{parc_name}_DCBC_'
+                                                                  f'{datetime.now()}.csv'),
+                                                  n_jobs = n_jobs)
             temp_eval_data_df = DCBC_average_df
 
             eval_data['L_DCBC'] = [temp_eval_data_df['DCBC'][temp_eval_data_df['hemisphere'] == 'L']]
@@ -80,7 +95,10 @@ def run_parcel_eval(parcellations,
                     parcellation_df = parcellation_dict.parcellation_df,
                     dist_file = None,
                     func_conn_file = None,
-                    func_conn_col_start = 3):
+                    func_conn_col_start = 3,
+                    scan_major = True,
+                    n_jobs = 1,
+                    cache_dir = None):
     """
     Wrapper function to run specified parcellations and metrics. 
 
@@ -97,9 +115,24 @@ def run_parcel_eval(parcellations,
     dist_file (optional): str
         Location of distance matrix file for DCBC. Please see DCBC GitHub repo for more information on obtaining distance matrix file (https://github.com/DiedrichsenLab/DCBC). Since this file is big, it cannot be readily uploaded onto GitHub repo.
     func_conn_file (optional): str or Dataframe 
-        csv file containing subject, session, and upper triangle of functional connectivity matrix; to be used to measure reliability and classification accuracy
+        Connectome store directory (see `conn_store.py`) or csv file containing subject,
+        session, and upper triangle of functional connectivity matrix; to be used to
+        measure reliability and classification accuracy. Connectome stores are
+        memory-mapped instead of parsed. Taken from the `func_conn_file` column of
+        `parcellation_df` when it has one
     func_conn_col_start : int
         Index of where the edge list values start. If output from `func_conn.conn_from_dir`, edge list values start at column 3. 
+    scan_major (optional) : bool
+        If true (default), FC homogeneity of all parcellations is computed in one pass
+        over the scans, so each scan is loaded and filtered once instead of once per
+        parcellation
+    n_jobs (optional) : int
+        Number of worker processes used to spread scans over when computing FC
+        homogeneity, and subjects and hemispheres when computing DCBC, and shuffle splits
+        when computing classification accuracy (-1 to use all cores)
+    cache_dir (optional) : str
+        Directory of an on-disk cache of preprocessed scans, so reruns skip decoding the
+        scans (see `cache.py`). If None, scans are not cached
 
     Returns
     -------
@@ -108,43 +141,89 @@ def run_parcel_eval(parcellations,
     """
     metric_dfs = []
 
-    for _, curr_parc in enumerate(parcellations):
-        print(f'Computing {curr_parc}') 
-
-        if parcellation_df is not None:
+    all_fchs_df = dict.fromkeys(parcellations)
+    if 'fc_homogeneity' in metrics and scan_major:
+        parc_fdatas = []
+        for _, curr_parc in enumerate(parcellations):
+            is_parc = parcellation_df['parcellation'] == curr_parc
+            parcellation_file = parcellation_df['parc_file'][is_parc].iloc[0]
+            _, parc_fdata = utils.load_data(parcellation_file, is_parcellation = True,
+                                            is_surface = surface, null_labels=null_labels)
+            parc_fdatas += [parc_fdata]
+
+        csv_filenames = [f'{curr_parc}_fch_{datetime.now()}.csv'
+                         for curr_parc in parcellations]
+        all_fchs_df = fc_homogeneity.run_fc_homogeneity_many(scans, parcellations,
+                                                             parc_fdatas, csv_filenames,
+                                                             surface, null_labels, n_jobs,
+                                                             cache_dir)
+        all_fchs_df = dict(zip(parcellations, all_fchs_df))
+        del parc_fdatas
+
+    # DCBC of all parcellations shares each subject's data and covariance
+    all_DCBC_average_df = dict.fromkeys(parcellations)
+    if 'dcbc' in metrics:
+        all_surface_parc = []
+        for _, curr_parc in enumerate(parcellations):
             parcel_surface_L_data = parcellation_df['surface_file_L'][parcellation_df['parcellation'] == curr_parc].iloc[0]
             parcel_surface_R_data = parcellation_df['surface_file_R'][parcellation_df['parcellation'] == curr_parc].iloc[0]
-            
+            all_surface_parc += [[nb.load(parcel_surface_L_data),
+                                  nb.load(parcel_surface_R_data)]]
+
+        csv_filenames = [f'{curr_parc}_DCBC_{datetime.now()}.csv'
+                         for curr_parc in parcellations]
+        all_DCBC = dcbc.run_DCBC_many(dist_file, parcellations, all_surface_parc,
+                                      csv_filenames, n_jobs)
+        all_DCBC_average_df = {curr_parc: DCBC_average_df
+                               for curr_parc, (_, DCBC_average_df)
+                               in zip(parcellations, all_DCBC)}
+
+    for _, curr_parc in enumerate(parcellations):
+        print(f'Computing {curr_parc}')
 
         if 'fc_homogeneity' in metrics:
-            parcellation_file = parcellation_df['parc_file'][parcellation_df['parcellation'] == curr_parc].iloc[0]
-            _, parc_fdata = utils.load_data(parcellation_file, is_parcellation = True, is_surface = surface, null_labels=null_labels)
+            if all_fchs_df[curr_parc] is None:
+                is_parc = parcellation_df['parcellation'] == curr_parc
+                parcellation_file = parcellation_df['parc_file'][is_parc].iloc[0]
+                _, parc_fdata = utils.load_data(parcellation_file, is_parcellation = True,
+                                                is_surface = surface,
+                                                null_labels=null_labels)
+            else:
+                parc_fdata = None
             func_conn_file = None
         else:
-            func_conn_file = parcellation_df['func_conn_file'][parcellation_df['parcellation'] == curr_parc].iloc[0]
+            if (parcellation_df is not None
+                    and 'func_conn_file' in parcellation_df.columns):
+                is_parc = parcellation_df['parcellation'] == curr_parc
+                func_conn_file = parcellation_df['func_conn_file'][is_parc].iloc[0]
             parc_fdata = None
 
         if func_conn_file is not None:
-            if isinstance(func_conn_file, pd.DataFrame):
+            if (isinstance(func_conn_file, pd.DataFrame)
+                    or conn_store.is_conn_store(func_conn_file)):
                 conn_df = func_conn_file
             else:
                 conn_df = pd.read_csv(func_conn_file)
 
         if 'reliability' in metrics: 
-            reliability_df = conn_df.copy()
-            if 'label' in reliability_df.columns:
-                reliability_df = reliability_df.drop('label', axis = 'columns')
+            if isinstance(conn_df, pd.DataFrame):
+                reliability_df = conn_df.copy()
+                if 'label' in reliability_df.columns:
+                    reliability_df = reliability_df.drop('label', axis = 'columns')
+            else:
+                reliability_df = conn_df
         else:
             reliability_df = None
             conn_df = func_conn_file 
 
-        if 'dcbc' in metrics:
-            parc_L_gii, parc_R_gii = nb.load(parcel_surface_L_data), nb.load(parcel_surface_R_data)
-            surface_parc = [parc_L_gii, parc_R_gii]
-        else:
-            surface_parc = None 
+        # surface parcellations are only needed by DCBC, which is computed above
+        surface_parc = None
 
-        temp_eval_data = run_all_metrics(scans, metrics, curr_parc, parc_fdata, dist_file, surface_parc, conn_df, reliability_df, func_conn_col_start, surface, null_labels)
+        temp_eval_data = run_all_metrics(scans, metrics, curr_parc, parc_fdata, dist_file,
+                                         surface_parc, conn_df, reliability_df,
+                                         func_conn_col_start, surface, null_labels,
+                                         all_fchs_df[curr_parc], n_jobs, cache_dir,
+                                         all_DCBC_average_df[curr_parc])
 
         metric_dfs += [temp_eval_data]
         
@@ -1,13 +1,31 @@
+import contextlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import repeat
+
 import numpy as np
 import pandas as pd
+from sklearn.metrics import (
+    accuracy_score,
+    balanced_accuracy_score,
+    f1_score,
+    precision_score,
+    recall_score,
+    roc_auc_score,
+)
+from sklearn.model_selection import KFold, ShuffleSplit
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.svm import SVC
-from sklearn.model_selection import ShuffleSplit
-import pandas as pd
-from datetime import datetime
-from sklearn.model_selection import KFold
-from sklearn.metrics import accuracy_score, balanced_accuracy_score, precision_score, recall_score, f1_score, roc_auc_score
+
+import sparque.conn_store as conn_store
+import sparque.utils as utils
+
+# C values searched by `svc_hyperparamterize`
+C_GRID = [1e-3,1e-2,1e-1,1e0,1e1,1e2,1e3,1e4,1e5]
+# number of folds of the C search
+N_FOLDS = 5
 
 def shuffle_split(X,test_size, n_splits=100):
     splits = ShuffleSplit(n_splits, random_state=0, test_size=test_size, train_size=None)
@@ -20,41 +38,132 @@ def shuffle_split(X,test_size, n_splits=100):
 
     return all_train_inds, all_test_inds
 
-def svc_hyperparamterize(X, y, train_inds, Cs=[1e-3,1e-3,1e-1,1e0,1e1,1e2,1e3,1e4,1e5]):
-    X_valid_set = X[train_inds]
-    y_valid_set = y[train_inds]
+def svc_fit_score(X_train, y_train, X_test, y_test, C):
+    '''
+    Fits an RBF support vector classifier on standardized features and returns its
+    accuracy on the test set
+    '''
+    SVC_model = make_pipeline(StandardScaler(),
+                            SVC(kernel = 'rbf', gamma='scale', C=C)
+                            )
+    SVC_model.fit(X_train, y_train)
 
-    scores = []
-    max_score_C = C[0]
+    return SVC_model.score(X_test, y_test)
 
-    kf = KFold(n_splits = 5, shuffle = True, random_state = 25)
-    kf.get_n_splits(X_valid_set)
+def kfold_splits(n_samples):
+    '''
+    Returns the (train, test) indices of the folds used to choose C, seeded so they are
+    the same in every process
+    '''
+    kf = KFold(n_splits = N_FOLDS, shuffle = True, random_state = 25)
+    return list(kf.split(np.zeros(n_samples)))
 
-    C_fold_scores = {'C': [], 'fold': [], 'score': []}
+def svc_fold_score(X, y, train_inds, C, fold):
+    '''
+    Cross-validation score of C on one fold of the training set of a split (same as one
+    fit of `svc_hyperparamterize`)
+    '''
+    train, test = kfold_splits(len(train_inds))[fold]
+    return svc_fit_score(X[train_inds[train]], y[train_inds[train]], X[train_inds[test]],
+                         y[train_inds[test]], C)
 
-    for C in Cs:
-        fold_scores = []
-        for i, (train, test) in enumerate(kf.split(X_valid_set)):
-            X_train, X_test, y_train, y_test = X_valid_set[train], X_valid_set[test], y_valid_set[train], y_valid_set[test]
-            SVC_model = make_pipeline(StandardScaler(), 
-                                    SVC(kernel = 'rbf', gamma='scale', C=C)
-                                    )
-            SVC_model.fit(X_train, y_train)
+def select_C(Cs, C_fold_scores):
+    '''
+    Returns the C with the highest mean fold score (the first one on ties)
+    '''
+    C_fold_scores = pd.DataFrame.from_dict(C_fold_scores)
+    C_scores = [C_fold_scores['score'][C_fold_scores['C'] == C].mean() for C in Cs]
+    return Cs[int(np.argmax(C_scores))]
+
+def svc_hyperparamterize(X, y, train_inds, Cs=C_GRID, search='grid', eta=3):
+    '''
+    Chooses C by cross-validation on the training set of a split. With `search='grid'`,
+    every C is scored on all folds. With `search='halving'`, see `svc_successive_halving`.
+
+    Returns
+    -----
+    C : float
+        Chosen C
+    C_fold_scores : dict
+        C, fold and score of every fit of the search
+    '''
+    if search == 'halving':
+        return svc_successive_halving(X, y, train_inds, Cs, eta)
+    elif search != 'grid':
+        raise ValueError(f"search must be 'grid' or 'halving', got {search!r}")
+
+    X_valid_set = X[train_inds]
+    y_valid_set = y[train_inds]
 
-            score = SVC_model.score(X_test, y_test)
+    C_fold_scores = {'C': [], 'fold': [], 'score': []}
 
-            fold_scores += [score]
+    for C in Cs:
+        for i, (train, test) in enumerate(kfold_splits(len(train_inds))):
+            score = svc_fit_score(X_valid_set[train], y_valid_set[train],
+                                  X_valid_set[test], y_valid_set[test], C)
 
             C_fold_scores['fold'] += [i]
             C_fold_scores['C'] += [C]
             C_fold_scores['score'] += [score]
 
-        C_score = np.mean(fold_scores)
-    
-        if C_score > np.max(scores):
-            max_score_C = C
-        
-    return max_score_C, C_fold_scores
+    return select_C(Cs, C_fold_scores), C_fold_scores
+
+def check_eta(eta):
+    '''
+    Raises a ValueError if the halving factor would not shrink the set of C values
+    '''
+    if not eta >= 2:
+        raise ValueError(f'eta must be at least 2, got {eta!r}')
+
+def svc_successive_halving(X, y, train_inds, Cs=C_GRID, eta=3):
+    '''
+    Chooses C by successive halving: every C is scored on one fold, then only the best
+    1/eta of them are scored on eta times as many folds, and so on until one C is left or
+    all folds are used. Ties keep the C that comes first in `Cs`. With the default 9
+    values, eta=3 and 5 folds, this takes 15 fits instead of the 45 of the full grid.
+
+    Returns
+    -----
+    C : float
+        Chosen C
+    C_fold_scores : dict
+        C, fold and score of every fit of the search
+    '''
+    check_eta(eta)
+
+    X_valid_set = X[train_inds]
+    y_valid_set = y[train_inds]
+    folds = kfold_splits(len(train_inds))
+
+    C_fold_scores = {'C': [], 'fold': [], 'score': []}
+
+    survivors = list(dict.fromkeys(Cs))
+    n_scored_folds = 0
+    n_folds = 1
+    while True:
+        for C in survivors:
+            for i in range(n_scored_folds, n_folds):
+                train, test = folds[i]
+                score = svc_fit_score(X_valid_set[train], y_valid_set[train],
+                                      X_valid_set[test], y_valid_set[test], C)
+
+                C_fold_scores['fold'] += [i]
+                C_fold_scores['C'] += [C]
+                C_fold_scores['score'] += [score]
+
+        if n_folds == len(folds):
+            break
+
+        C_scores = pd.DataFrame.from_dict(C_fold_scores)
+        C_scores = C_scores.groupby('C', sort = False)['score'].mean()
+        ranking = np.argsort(-C_scores[survivors].to_numpy(), kind = 'stable')
+        survivors = [survivors[i] for i in ranking[:max(1, len(survivors) // eta)]]
+        if len(survivors) == 1:
+            break
+
+        n_scored_folds, n_folds = n_folds, min(n_folds * eta, len(folds))
+
+    return select_C(survivors, C_fold_scores), C_fold_scores
 
 def svc_test(X, y, train_inds, test_inds, C):
     X_train, Y_train = X[train_inds], y[train_inds]
@@ -65,22 +174,53 @@ def svc_test(X, y, train_inds, test_inds, C):
                              )
     SVC_model.fit(X_train, Y_train)
 
-    train_pred = SVC_model.predict(X_train)
     test_pred = SVC_model.predict(X_test)
 
-    metric_results = {'accuracy': accuracy_score(Y_train, train_pred),
+    # labels are usually subjects, so precision, recall and F1 are averaged over classes,
+    # and AUC is only defined for two classes
+    if len(SVC_model.classes_) == 2:
+        AUC = roc_auc_score(Y_test, SVC_model.decision_function(X_test))
+    else:
+        AUC = np.nan
+
+    metric_results = {'accuracy': accuracy_score(Y_test, test_pred),
                       'balanced_accuracy': balanced_accuracy_score(Y_test, test_pred),
-                      'precision': precision_score(Y_test, test_pred),
-                      'recall': recall_score(Y_test, test_pred),
-                      'AUC': roc_auc_score(Y_test, test_pred),
-                      'F1': f1_score(Y_test, test_pred)
+                      'precision': precision_score(Y_test, test_pred, average = 'macro',
+                                                   zero_division = 0),
+                      'recall': recall_score(Y_test, test_pred, average = 'macro',
+                                             zero_division = 0),
+                      'AUC': AUC,
+                      'F1': f1_score(Y_test, test_pred, average = 'macro',
+                                     zero_division = 0)
                      }
 
-    metric_results_df = pd.DataFrame.from_dict(metric_results)
+    return metric_results
 
-    return metric_results_df
+def _load_shared_X(X_shared):
+    # X is shared as a `.npy` file (see `utils.save_shared_array`), or as the (filename,
+    # dtype, shape) of the edges file of a connectome store
+    if isinstance(X_shared, tuple):
+        filename, dtype, shape = X_shared
+        return np.memmap(filename, dtype = dtype, mode = 'r', shape = shape)
+    return utils.load_shared_array(X_shared)
 
-def run_svc_with_shuffle_split(conn_matrix_df):
+def _run_split_from_shared(X_shared, y, train_inds, test_inds, search, eta):
+    X = _load_shared_X(X_shared)
+    C, C_fold_scores = svc_hyperparamterize(X, y, train_inds, C_GRID, search, eta)
+    return C, C_fold_scores, svc_test(X, y, train_inds, test_inds, C)
+
+def _fold_score_from_shared(X_shared, y, train_inds, C, fold):
+    return svc_fold_score(_load_shared_X(X_shared), y, train_inds, C, fold)
+
+def _svc_test_from_shared(X_shared, y, train_inds, test_inds, C):
+    return svc_test(_load_shared_X(X_shared), y, train_inds, test_inds, C)
+
+def load_conn_df_X_y(conn_matrix_df):
+    '''
+    Returns the edge lists (X) and labels (y) of a dataframe or `.csv` of edge lists
+    (output from `func_conn.conn_from_dir`). Sessions with nan values are dropped and
+    recorded in `svc_log_{current date and time}.txt`
+    '''
     if not isinstance(conn_matrix_df, pd.DataFrame):
         conn_matrix_df = pd.read_csv(conn_matrix_df, sep = ',')
 
@@ -97,23 +237,146 @@ def run_svc_with_shuffle_split(conn_matrix_df):
     X = conn_matrix_df.iloc[:,conn_matrix_start:conn_matrix_end].copy().values
     y = conn_matrix_df['label'].copy().values
 
-    split_performance = {'split': [], 'C': [], 'accuracy': [], 'balanced_accuracy': [], 'precision': [], 'recall': [], 'AUC': [], 'F1': []}
+    return X, y
+
+def load_conn_store_X_y(store_dir):
+    '''
+    Returns the edge lists (X) and labels (y) of a connectome store (see `conn_store.py`).
+    X stays memory-mapped unless sessions with nan values have to be dropped; those are
+    recorded in `svc_log_{current date and time}.txt`
+    '''
+    metadata, X = conn_store.load_conn_store(store_dir)
+    nan_rows = np.isnan(X).any(axis=1)
+    with open(f'svc_log_{datetime.now()}.txt', 'w') as f:
+        f.write(f'rows dropped \n {metadata[nan_rows]}')
+
+    if nan_rows.any():
+        X = X[~nan_rows]
+    y = metadata['label'].astype("category").to_numpy()[~nan_rows]
 
-    train_inds, test_inds = shuffle_split(X, test_size = 0.25, n_splits = 100)
-    for i, (train_inds, test_inds) in enumerate(zip(train_inds, test_inds)):
-        C, C_fold_scores = svc_hyperparamterize(X, y, train_inds)
-        
-        metrics_results = svc_test(X, y, train_inds, test_inds, C)
+    return X, y
 
-        split_performance['accuracy'] += [metrics_results['accuracy']]
-        split_performance['balanced_accuracy'] += [metrics_results['balanced_accuracy']]
-        split_performance['precision'] += [metrics_results['precision']]
-        split_performance['recall'] += [metrics_results['recall']]
-        split_performance['AUC'] += [metrics_results['AUC']]
-        split_performance['F1'] += [metrics_results['F1']]
-        split_performance['split'] += [i]
-        split_performance['C'] += [C]
+def run_svc_with_shuffle_split(conn_matrix_df, n_jobs = 1, parallel_folds = False,
+                               n_splits = 100, search = 'grid', eta = 3):
+    '''
+    Classification accuracy of a support vector classifier across shuffled splits,
+    choosing C by 5-fold cross-validation on the training set of each split
+
+    Parameters
+    -----
+    conn_matrix_df : dataframe object or str
+        Dataframe or `.csv` of edge lists with a label column (output from
+        `func_conn.conn_from_dir`), or directory of a connectome store (see
+        `conn_store.py`)
+    n_jobs (optional) : int
+        Number of worker processes used to spread splits over (-1 to use all cores). X is
+        shared with the workers as a memory-mapped file, the edges file of a connectome
+        store itself when no session is dropped. Splits and folds are seeded, so results
+        match the serial run exactly
+    parallel_folds (optional) : bool
+        If true, every (split, C, fold) fit of the C search is a separate task, which
+        keeps more workers busy than one task per split when there are more workers than
+        splits. Only used with the grid search
+    n_splits (optional) : int
+        Number of shuffled splits
+    search (optional) : str
+        'grid' to score every C on every fold, or 'halving' to drop poor C values after a
+        few folds (see `svc_successive_halving`)
+    eta (optional) : int
+        Fraction of C values dropped at each step of the halving search, and factor of
+        folds added
+
+    Returns
+    -----
+    split_performance_df : dataframe
+        C, number of fits and test metrics of each split
+    C_fold_scores : dict
+        Fold scores of every C of the last split
+    '''
+    if search == 'halving':
+        check_eta(eta)
+
+    if conn_store.is_conn_store(conn_matrix_df):
+        X, y = load_conn_store_X_y(conn_matrix_df)
+    else:
+        X, y = load_conn_df_X_y(conn_matrix_df)
+
+    split_performance = {'split': [], 'C': [], 'n_fits': [], 'accuracy': [],
+                         'balanced_accuracy': [], 'precision': [], 'recall': [],
+                         'AUC': [], 'F1': []}
+
+    all_train_inds, all_test_inds = shuffle_split(X, test_size = 0.25,
+                                                  n_splits = n_splits)
+
+    search_spec = f'search={search}, Cs={C_GRID}, folds={N_FOLDS}, splits={n_splits}'
+    if search == 'halving':
+        search_spec += f', eta={eta}'
+    print(f'Choosing C with {search_spec}')
+
+    with contextlib.ExitStack() as stack:
+        if n_jobs == 1:
+            all_Cs, all_C_fold_scores = zip(*map(svc_hyperparamterize, repeat(X),
+                                                 repeat(y), all_train_inds,
+                                                 repeat(C_GRID), repeat(search),
+                                                 repeat(eta)))
+            all_metrics_results = map(svc_test, repeat(X), repeat(y), all_train_inds,
+                                      all_test_inds, all_Cs)
+        else:
+            if isinstance(X, np.memmap):
+                # edges of a connectome store without nan rows, mapped by the workers from
+                # the store itself
+                X_shared = (X.filename, X.dtype.str, X.shape)
+            else:
+                shared_dir = stack.enter_context(tempfile.TemporaryDirectory())
+                X_shared = utils.save_shared_array(X, shared_dir)
+            executor = stack.enter_context(
+                ProcessPoolExecutor(max_workers = utils.get_n_jobs(n_jobs)))
+
+            if parallel_folds and search == 'grid':
+                tasks = [(i, C, fold) for i in range(len(all_train_inds))
+                         for C in C_GRID for fold in range(N_FOLDS)]
+                # map returns scores in the order of tasks
+                scores = executor.map(_fold_score_from_shared, repeat(X_shared),
+                                      repeat(y), [all_train_inds[i] for i, _, _ in tasks],
+                                      [C for _, C, _ in tasks],
+                                      [fold for _, _, fold in tasks])
+
+                all_C_fold_scores = [{'C': [], 'fold': [], 'score': []}
+                                     for _ in all_train_inds]
+                for (i, C, fold), score in zip(tasks, scores):
+                    all_C_fold_scores[i]['C'] += [C]
+                    all_C_fold_scores[i]['fold'] += [fold]
+                    all_C_fold_scores[i]['score'] += [score]
+                all_Cs = [select_C(C_GRID, C_fold_scores)
+                          for C_fold_scores in all_C_fold_scores]
+
+                all_metrics_results = executor.map(_svc_test_from_shared,
+                                                   repeat(X_shared), repeat(y),
+                                                   all_train_inds, all_test_inds, all_Cs)
+            else:
+                split_results = executor.map(_run_split_from_shared, repeat(X_shared),
+                                             repeat(y), all_train_inds, all_test_inds,
+                                             repeat(search), repeat(eta))
+                all_Cs, all_C_fold_scores, all_metrics_results = zip(*split_results)
+
+        for i, (C, C_fold_scores, metrics_results) in enumerate(
+                zip(all_Cs, all_C_fold_scores, all_metrics_results)):
+            split_performance['accuracy'] += [metrics_results['accuracy']]
+            split_performance['balanced_accuracy'] += [
+                metrics_results['balanced_accuracy']]
+            split_performance['precision'] += [metrics_results['precision']]
+            split_performance['recall'] += [metrics_results['recall']]
+            split_performance['AUC'] += [metrics_results['AUC']]
+            split_performance['F1'] += [metrics_results['F1']]
+            split_performance['split'] += [i]
+            split_performance['C'] += [C]
+            # fits of the C search and the final fit
+            split_performance['n_fits'] += [len(C_fold_scores['score']) + 1]
 
     split_performance_df = pd.DataFrame.from_dict(split_performance)
+
+    with open(f'svc_search_log_{datetime.now()}.txt', 'w') as f:
+        f.write(f'{search_spec} \n total fits {split_performance_df["n_fits"].sum()}')
+    print(f'Fitted {split_performance_df["n_fits"].sum()} classifiers with {search_spec}')
     
-    return split_performance_df, C_fold_scores
\ No newline at end of file
+    return split_performance_df, all_C_fold_scores[-1]
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import tables
+
+# compression of the time series datasets; zlib ships with every HDF5 build
+FILTERS = tables.Filters(complevel = 5, complib = 'zlib', shuffle = True)
+
+class TimeSeriesIndex(tables.IsDescription):
+    subject = tables.StringCol(64, pos = 0)
+    session = tables.StringCol(64, pos = 1)
+    key = tables.StringCol(32, pos = 2)
+
+def open_time_series_store(filename, mode = 'a'):
+    '''
+    Opens a time-series store, creating it if needed. A store is an HDF5 file (written
+    with PyTables) holding the parcellated time series of each session as its own chunked,
+    compressed dataset under `/time_series`, and a `/index` table with the subject,
+    session and dataset key of each session. Sessions are added one at a time with
+    `append_time_series`, so time series do not have to be kept in memory until the end of
+    a run, and any session can be read without loading the others (see
+    `load_time_series`).
+
+    Parameters
+    -----
+    filename : str
+        Filename of the store, currently `{parc_name}_time_series.h5`
+    mode (optional) : str
+        'a' to append to an existing store, 'w' to overwrite it
+
+    Returns
+    -----
+    h5file : tables.File
+        Open store, to be closed by the caller
+    '''
+    h5file = tables.open_file(filename, mode = mode)
+    if '/index' not in h5file:
+        h5file.create_table('/', 'index', TimeSeriesIndex,
+                            'subject and session of each time series')
+        h5file.create_group('/', 'time_series',
+                            'parcellated time series, one dataset per session')
+    return h5file
+
+def append_time_series(h5file, subject, session, time_series):
+    '''
+    Writes the time series of one session to an open store (see `open_time_series_store`)
+    and adds it to the index. Returns the key of its dataset.
+    '''
+    time_series = np.asarray(time_series)
+    index = h5file.root.index
+    key = f'session_{index.nrows}'
+
+    dataset = h5file.create_carray(h5file.root.time_series, key, obj = time_series,
+                                   filters = FILTERS)
+    dataset.flush()
+    index.append([(str(subject), str(session), key)])
+    index.flush()
+    return key
+
+def load_time_series_index(filename):
+    '''
+    Returns the index of a time-series store as a dataframe of subject, session and
+    dataset key (as str), without reading any time series
+    '''
+    with tables.open_file(filename, mode = 'r') as h5file:
+        index = h5file.root.index.read()
+    return pd.DataFrame({column: np.char.decode(index[column])
+                         for column in ['subject', 'session', 'key']})
+
+def load_time_series(filename, key):
+    '''
+    Reads the time series of one session of a store, given its key in the index (see
+    `load_time_series_index`)
+    '''
+    with tables.open_file(filename, mode = 'r') as h5file:
+        return h5file.get_node(h5file.root.time_series, key).read()
+
+def load_time_series_df(filename):
+    '''
+    Reads a whole time-series store into a dataframe of subject, session and time series,
+    the layout `func_conn.conn_from_dir` used to store
+    '''
+    time_series_df = load_time_series_index(filename)
+    with tables.open_file(filename, mode = 'r') as h5file:
+        time_series = h5file.root.time_series
+        time_series_df['time_series'] = [h5file.get_node(time_series, key).read()
+                                         for key in time_series_df['key']]
+    return time_series_df.drop(columns = 'key')
@@ -1,9 +1,14 @@
+import importlib
+import os
+import uuid
+
+import neuromaps
+import nibabel as nb
 import numpy as np
 import pandas as pd
-import nibabel as nb
-import neuromaps
 from nilearn.image import resample_img
-import importlib 
+from scipy import sparse
+
 
 def sem(array):
     return np.std(array) / np.sqrt(np.size(array))
@@ -46,12 +51,103 @@ def convert_mni_to_fslr32k(scan_filename,
 
 
 def get_unique_parcels(atlas_fdata):
-    unique_parcs = set(atlas_fdata.ravel().tolist()) - {0}
+    unique_parcs = set(np.unique(atlas_fdata).tolist()) - {0}
     return unique_parcs
 
+def build_parcel_index(atlas_fdata, drop_null = True):
+    '''
+    Builds a label index of a parcellation so that the members of every parcel can be
+    taken as a slice instead of scanning the whole volume once per parcel
+
+    Parameters
+    -----
+    atlas_fdata : array_like
+        Parcellation labels, any shape (raveled in C order, so voxel indices match
+        `atlas_fdata.ravel()`)
+    drop_null (optional) : bool
+        If true, voxels labelled 0 are left out of the index
+
+    Returns
+    -----
+    parcels : array_like
+        Sorted parcel labels
+    order : array_like
+        Voxel indices sorted by parcel (stable, so voxels keep their original order within
+        a parcel)
+    offsets : array_like
+        Members of `parcels[i]` are `order[offsets[i]:offsets[i + 1]]`
+    '''
+    labels = np.asarray(atlas_fdata).ravel()
+    parcels, inverse = np.unique(labels, return_inverse = True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind = 'stable')
+    parcel_sizes = np.bincount(inverse, minlength = parcels.size)
+
+    if drop_null:
+        is_labelled = parcels != 0
+        order = order[labels[order] != 0]
+        parcels = parcels[is_labelled]
+        parcel_sizes = parcel_sizes[is_labelled]
+
+    offsets = np.concatenate(([0], np.cumsum(parcel_sizes)))
+    return parcels, order, offsets
+
+def filter_parcel_index(parcel_index, keep):
+    '''
+    Restricts a label index (see `build_parcel_index`) to the voxels marked in the boolean
+    mask `keep`. Voxel indices of the returned index refer to positions among the kept
+    voxels, and parcels left without voxels are dropped.
+    '''
+    parcels, order, offsets = parcel_index
+    kept_position = np.cumsum(keep) - 1
+
+    is_kept = keep[order]
+    n_kept_before = np.concatenate(([0], np.cumsum(is_kept)))
+    parcel_sizes = n_kept_before[offsets[1:]] - n_kept_before[offsets[:-1]]
+    has_voxels = parcel_sizes > 0
+
+    order = kept_position[order[is_kept]]
+    offsets = np.concatenate(([0], np.cumsum(parcel_sizes[has_voxels])))
+    return parcels[has_voxels], order, offsets
+
+def label_operator(labels, dtype = np.float32):
+    '''
+    Builds the sparse averaging operator of a parcellation, so that the parcel means of
+    (voxels x time) data are one sparse product `operator @ data[mask]`
+
+    Parameters
+    -----
+    labels : array_like
+        Parcellation labels, any shape (raveled in C order). Voxels labelled 0 are left
+        out
+    dtype (optional) : dtype
+        Data type of the operator weights, float32 by default
+
+    Returns
+    -----
+    parcels : array_like
+        Sorted parcel labels, one per row of the operator
+    mask : array_like
+        Boolean mask of the labelled voxels, raveled
+    operator : sparse matrix
+        (parcels x labelled voxels) CSR matrix with weight 1 / parcel size at the parcel
+        of each voxel
+    '''
+    labels = np.asarray(labels).ravel()
+    mask = labels != 0
+    parcels, inverse, parcel_sizes = np.unique(labels[mask], return_inverse = True,
+                                               return_counts = True)
+
+    weights = (1 / parcel_sizes)[inverse].astype(dtype)
+    operator = sparse.csr_matrix((weights, (inverse.ravel(), np.arange(inverse.size))),
+                                 shape = (parcels.size, inverse.size))
+    return parcels, mask, operator
+
 def load_data(data, is_parcellation = False, is_surface = False, null_labels=()):
     '''
-    Loads scan data via nibabel as outputs the loaded scan and fdata
+    Loads scan data via nibabel as outputs the loaded scan and fdata. See
+    `load_masked_data` for a lower-memory loader returning in-mask voxels as (voxels x
+    time).
     '''
     loaded_data = nb.load(data)
 
@@ -71,6 +167,60 @@ def load_data(data, is_parcellation = False, is_surface = False, null_labels=())
 
     return loaded_data, fdata 
 
+def load_masked_data(data, mask = None, dtype = np.float32, is_surface = False,
+                     chunk_size = 50):
+    '''
+    Loads the in-mask voxels of scan data as a (voxels x time) array without materializing
+    the whole float64 volume like `load_data` does. Volumes are read through `dataobj`
+    (memory-mapped when the file is uncompressed) a chunk of time points at a time, so the
+    peak memory is the output array plus one chunk.
+
+    Parameters
+    -----
+    data : str
+        Filepath of scan
+    mask (optional) : array_like
+        Boolean mask over the voxels (or vertices) of the scan, raveled in C order. If
+        None, all voxels are returned
+    dtype (optional) : dtype
+        Data type of the returned array, float32 by default
+    is_surface (optional) : bool
+        If true, loads a GIFTI file with one data array per time point
+    chunk_size (optional) : int
+        Number of time points read at once from a volume
+
+    Returns
+    -----
+    loaded_data : nibabel loaded object of the scan
+    fdata : array_like
+        In-mask time series, shape (voxels, time)
+    '''
+    if is_surface:
+        loaded_data = nb.load(data)
+        fdata = np.stack([arr.data for arr in loaded_data.darrays], axis = 1)
+        fdata = fdata.astype(dtype, copy = False)
+        if mask is not None:
+            fdata = fdata[np.asarray(mask, dtype = bool).ravel()]
+        return loaded_data, fdata
+
+    # keep_file_open lets sequential chunks of a .nii.gz resume the gzip stream instead of
+    # decoding it from the start
+    loaded_data = nb.load(data, mmap = True, keep_file_open = True)
+    n_voxels = int(np.prod(loaded_data.shape[:-1]))
+    n_timepoints = loaded_data.shape[-1]
+
+    if mask is None:
+        mask = np.ones(n_voxels, dtype = bool)
+    mask = np.asarray(mask, dtype = bool).ravel()
+
+    fdata = np.empty((np.count_nonzero(mask), n_timepoints), dtype = dtype)
+    for start in range(0, n_timepoints, chunk_size):
+        stop = min(start + chunk_size, n_timepoints)
+        data_chunk = np.asarray(loaded_data.dataobj[..., start:stop])
+        fdata[:, start:stop] = data_chunk.reshape(n_voxels, stop - start)[mask]
+
+    return loaded_data, fdata
+
 def resample_to_data(atlas, loaded_data):
     '''
     Resamples parcellation file (atlas) to nibabel loaded scan data (loaded_data) 
@@ -88,7 +238,7 @@ def get_mask(mask, data):
     Resamples to mask
     '''
     if (mask == 'MNI' and importlib.util.find_spec('templateflow')):
-        import templateflow.api as tflow 
+        import templateflow.api as tflow
         img_mask = tflow.get('MNI152NLin2009cAsym', desc='brain', suffix='mask', resolution=2)
     else: 
         img_mask = mask
@@ -121,4 +271,50 @@ def load_multiple_scans(scans):
         loaded_data, _ = load_data(scan)
         loaded_scans += [loaded_data]
     
-    return loaded_scans
\ No newline at end of file
+    return loaded_scans
+
+def get_n_jobs(n_jobs):
+    '''
+    Resolves the number of worker processes like joblib: negative values count back from
+    the number of cores, so -1 means all cores and -2 all but one. Raises a ValueError for
+    0 or for negative values asking for fewer than one worker.
+    '''
+    if n_jobs < 0:
+        n_cores = os.cpu_count()
+        if n_jobs < -n_cores:
+            raise ValueError(f'n_jobs={n_jobs} leaves no worker on {n_cores} cores, '
+                             f'use a value from {-n_cores} to -1')
+        return n_cores + 1 + n_jobs
+    if n_jobs == 0:
+        raise ValueError('n_jobs must not be 0')
+    return n_jobs
+
+def limit_memory(max_bytes = None):
+    '''
+    Limits the address space of the current process to `max_bytes` (used as initializer of
+    worker processes), so allocations beyond it raise a MemoryError. Does nothing if
+    `max_bytes` is None or on platforms without the `resource` module.
+    '''
+    if max_bytes is None:
+        return
+    try:
+        import resource
+    except ImportError:
+        return
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, hard_limit))
+
+def save_shared_array(array, shared_dir):
+    '''
+    Saves an array as a `.npy` file in `shared_dir` so worker processes can memory-map it
+    (see `load_shared_array`) instead of receiving a pickled copy. Returns the filename.
+    '''
+    filename = os.path.join(shared_dir, f'{uuid.uuid4().hex}.npy')
+    np.save(filename, array)
+    return filename
+
+def load_shared_array(filename):
+    '''
+    Memory-maps an array saved by `save_shared_array` as read-only
+    '''
+    return np.load(filename, mmap_mode = 'r')
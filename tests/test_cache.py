@@ -0,0 +1,118 @@
+'''
+Unit tests for cache
+'''
+
+import os
+
+import numpy as np
+import pytest
+
+import sparque.cache as cache
+
+
+def test_get_or_compute(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    calls = []
+    def compute():
+        calls.append(1)
+        return np.arange(10.), np.eye(3)
+
+    first = cache.get_or_compute(cache_dir, 'key', compute, n_arrays = 2)
+    second = cache.get_or_compute(cache_dir, 'key', compute, n_arrays = 2)
+
+    assert len(calls) == 1
+    assert isinstance(second[0], np.memmap)
+    for computed, cached in zip(first, second):
+        assert np.array_equal(computed, cached)
+
+    # without a cache directory nothing is stored
+    cache.get_or_compute(None, None, compute, n_arrays = 2)
+    assert len(calls) == 2
+
+def test_cache_key(tmp_path):
+    filename = tmp_path / 'scan.bin'
+    filename.write_bytes(b'scan')
+    copy = tmp_path / 'copy.bin'
+    copy.write_bytes(b'scan')
+
+    mask_hash = cache.array_hash(np.ones(4, dtype = bool))
+    other_mask_hash = cache.array_hash(np.zeros(4, dtype = bool))
+
+    key = cache.cache_key(str(filename), step = 'masked_data', mask = mask_hash)
+    assert cache.cache_key(str(copy), step = 'masked_data', mask = mask_hash) == key
+    assert cache.cache_key(str(filename), step = 'masked_data',
+                           mask = other_mask_hash) != key
+    assert cache.cache_key(str(filename), step = 'label_extractor',
+                           mask = mask_hash) != key
+
+    filename.write_bytes(b'other scan')
+    assert cache.cache_key(str(filename), step = 'masked_data', mask = mask_hash) != key
+
+def test_save_cached_atomic(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path)
+    replaced = []
+    replace = os.replace
+    def record_replace(src, dst):
+        replaced.append((src, dst))
+        replace(src, dst)
+    monkeypatch.setattr(cache.os, 'replace', record_replace)
+
+    cache.save_cached(cache_dir, 'key', (np.arange(5), np.ones(2)))
+
+    assert [os.path.basename(dst) for _, dst in replaced] == ['key_0.npy', 'key_1.npy']
+    assert all(src.endswith('.tmp') for src, _ in replaced)
+    assert sorted(os.listdir(cache_dir)) == ['key_0.npy', 'key_1.npy']
+    assert np.array_equal(cache.load_cached(cache_dir, 'key', 2)[0], np.arange(5))
+
+def test_evict(tmp_path):
+    cache_dir = str(tmp_path)
+    array = np.zeros(1000)
+    for i, key in enumerate(['old', 'used', 'new']):
+        cache.save_cached(cache_dir, key, (array,))
+        os.utime(os.path.join(cache_dir, f'{key}_0.npy'), ns = (i * 10 ** 9, i * 10 ** 9))
+    entry_bytes = os.path.getsize(os.path.join(cache_dir, 'old_0.npy'))
+
+    # a hit makes an entry the most recently used
+    cache.load_cached(cache_dir, 'old')
+    cache.evict(cache_dir, max_cache_bytes = 2 * entry_bytes)
+
+    assert sorted(os.listdir(cache_dir)) == ['new_0.npy', 'old_0.npy']
+    assert cache.load_cached(cache_dir, 'used') is None
+
+def test_evict_whole_entries(tmp_path):
+    cache_dir = str(tmp_path)
+    arrays = (np.zeros(1000), np.zeros(1000))
+    cache.save_cached(cache_dir, 'old', arrays)
+    os.utime(os.path.join(cache_dir, 'old_0.npy'), ns = (0, 0))
+    os.utime(os.path.join(cache_dir, 'old_1.npy'), ns = (10 ** 9, 10 ** 9))
+    entry_bytes = sum(os.path.getsize(os.path.join(cache_dir, f'old_{i}.npy'))
+                      for i in range(2))
+
+    # the files of an entry are evicted together
+    cache.save_cached(cache_dir, 'new', arrays, max_cache_bytes = entry_bytes)
+    assert sorted(os.listdir(cache_dir)) == ['new_0.npy', 'new_1.npy']
+
+    # the entry just written is kept even if it alone exceeds the bound
+    with pytest.warns(UserWarning):
+        cache.save_cached(cache_dir, 'big', arrays, max_cache_bytes = entry_bytes - 1)
+    assert sorted(os.listdir(cache_dir)) == ['big_0.npy', 'big_1.npy']
+
+def test_file_hash_persisted(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    filename = tmp_path / 'scan.bin'
+    filename.write_bytes(b'scan')
+
+    key = cache.cache_key(str(filename), cache_dir, step = 'masked_data')
+    hash_filename, = (tmp_path / 'cache' / cache.FILE_HASHES_DIR).iterdir()
+    assert hash_filename.read_text() == cache.file_hash(str(filename))
+
+    # a new process reads the hash from the cache directory instead of the file
+    monkeypatch.setattr(cache, '_file_hashes', {})
+    hash_filename.write_text('stored')
+    assert cache.file_hash(str(filename), cache_dir = cache_dir) == 'stored'
+    assert cache.cache_key(str(filename), cache_dir, step = 'masked_data') != key
+
+    # changing the file changes its size or modification time, so it is hashed again
+    monkeypatch.setattr(cache, '_file_hashes', {})
+    filename.write_bytes(b'other scan')
+    assert cache.file_hash(str(filename), cache_dir = cache_dir) != 'stored'
@@ -0,0 +1,74 @@
+'''
+Unit tests for DCBC compute_distance
+'''
+
+import nibabel as nb
+import numpy as np
+import pytest
+from scipy.sparse import csgraph
+from scipy.spatial.distance import cdist
+
+from sparque.DCBC import compute_distance
+
+MAX_DIST = 4.5
+
+def make_surface(n_side=12, seed=0):
+    # jittered triangulated grid, so that edge lengths and path lengths vary
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.arange(n_side), np.arange(n_side), indexing='ij')
+    vertices = np.stack([x.ravel(), y.ravel(), np.zeros(x.size)], axis=1).astype(float)
+    vertices += rng.uniform(-0.2, 0.2, vertices.shape)
+
+    index = np.arange(n_side * n_side).reshape(n_side, n_side)
+    corner = index[:-1, :-1].ravel()
+    faces = np.concatenate([np.stack([corner, corner + 1, corner + n_side], axis=1),
+                            np.stack([corner + 1, corner + n_side + 1, corner + n_side],
+                                     axis=1)])
+    return vertices, faces
+
+def threshold(dist, max_dist, decimals=3):
+    dist = np.round(dist, decimals)
+    dist[(dist > max_dist) | ~np.isfinite(dist)] = 0
+    np.fill_diagonal(dist, 0)
+    return dist
+
+def test_euclidean_distance_sparse():
+    vertices, _ = make_surface()
+
+    dist = compute_distance.euclidean_distance_sparse(vertices, MAX_DIST)
+
+    assert np.array_equal(dist.toarray(), threshold(cdist(vertices, vertices), MAX_DIST))
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 144, 500])
+def test_geodesic_distance_sparse(chunk_size):
+    vertices, faces = make_surface()
+    graph = compute_distance.surface_edges(vertices, faces)
+    full_dist = csgraph.dijkstra(graph, directed=False)
+
+    dist = compute_distance.geodesic_distance_sparse(vertices, faces, MAX_DIST,
+                                                     chunk_size=chunk_size)
+
+    assert np.array_equal(dist.toarray(), threshold(full_dist, MAX_DIST))
+
+def test_compute_dist(tmp_path):
+    vertices, faces = make_surface()
+    surf_file = str(tmp_path / 'surface.surf.gii')
+    gii = nb.gifti.GiftiImage(darrays=[
+        nb.gifti.GiftiDataArray(vertices.astype(np.float32),
+                                intent='NIFTI_INTENT_POINTSET'),
+        nb.gifti.GiftiDataArray(faces.astype(np.int32), intent='NIFTI_INTENT_TRIANGLE')])
+    nb.save(gii, surf_file)
+    vertices = vertices.astype(np.float32).astype(np.float64)
+
+    dijkstra = compute_distance.compute_dist(surf_file, 'dijkstra', max_dist=MAX_DIST)
+    dijstra = compute_distance.compute_dist(surf_file, 'dijstra', max_dist=MAX_DIST)
+    euclidean = compute_distance.compute_dist(surf_file, 'euclidean', max_dist=MAX_DIST,
+                                              dense=False)
+
+    assert np.array_equal(dijkstra.toarray(), dijstra.toarray())
+    geodesic = compute_distance.geodesic_distance_sparse(vertices, faces, MAX_DIST)
+    assert np.array_equal(dijkstra.toarray(), geodesic.toarray())
+    assert np.array_equal(euclidean, compute_distance.euclidean_distance_sparse(
+        vertices, MAX_DIST).toarray())
+    with pytest.raises(TypeError):
+        compute_distance.compute_dist(surf_file, 'geodesic', max_dist=MAX_DIST)
@@ -0,0 +1,79 @@
+'''
+Unit tests for DCBC compute_similarity
+'''
+
+import nibabel as nb
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.spatial.distance import cdist
+
+from sparque.DCBC import compute_similarity
+
+# more vertices than the default block size, so pairs span a block boundary
+N_VERTICES = 1500
+N_CONDITIONS = 20
+
+def make_data(seed=0):
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal((N_VERTICES, N_CONDITIONS)).astype(np.float32)
+    pairs = sparse.random(N_VERTICES, N_VERTICES, density=0.01, format='csr',
+                          random_state=seed)
+    return data, pairs + pairs.T
+
+def assert_same_pairs(r, pairs, dense):
+    r = r.tocoo()
+    assert r.nnz == pairs.nnz
+    pairs = pairs.tocoo()
+    assert np.array_equal(np.sort(r.row * N_VERTICES + r.col),
+                          np.sort(pairs.row * N_VERTICES + pairs.col))
+    assert np.allclose(r.data, dense[r.row, r.col], atol=1e-5)
+
+@pytest.mark.parametrize('block_size', [1024, 100, N_VERTICES])
+def test_pair_similarity(block_size):
+    data, pairs = make_data()
+    centered = data - data.mean(axis=1)[:, np.newaxis]
+
+    pearson = compute_similarity.pair_similarity(data, pairs, 'pearson',
+                                                 block_size=block_size)
+    cosine = compute_similarity.pair_similarity(data, pairs, 'cosine',
+                                                mean_centering=False,
+                                                block_size=block_size)
+    centered_cosine = compute_similarity.pair_similarity(data, pairs, 'cosine',
+                                                         block_size=block_size)
+
+    assert_same_pairs(pearson, pairs, np.corrcoef(data))
+    assert_same_pairs(cosine, pairs, 1 - cdist(data, data, 'cosine'))
+    assert_same_pairs(centered_cosine, pairs, np.corrcoef(data))
+    precentered_cosine = compute_similarity.pair_similarity(centered, pairs, 'cosine')
+    assert np.allclose(precentered_cosine.toarray(), centered_cosine.toarray(), atol=1e-6)
+
+def test_normalize_rows():
+    data, _ = make_data()
+    data[3] = 0
+
+    normed = compute_similarity.normalize_rows(data)
+
+    assert np.allclose(np.linalg.norm(np.delete(normed, 3, axis=0), axis=1), 1)
+    assert np.isnan(normed[3]).all()
+
+def test_cosine():
+    data, _ = make_data()
+    other = data[::-1] * 3
+
+    assert np.allclose(compute_similarity.cosine(data), 1 - cdist(data, data, 'cosine'))
+    assert np.allclose(compute_similarity.cosine(data, other),
+                       1 - cdist(data, other, 'cosine'))
+    assert np.allclose(np.diag(compute_similarity.cosine(data)), 1)
+
+@pytest.mark.parametrize('type', ['cosine', 'pearson'])
+def test_compute_similarity_pairs(tmp_path, type):
+    data, pairs = make_data()
+    data_file = str(tmp_path / 'subject.L.wbeta.32k.func.gii')
+    darrays = [nb.gifti.GiftiDataArray(data[:, k]) for k in range(N_CONDITIONS)]
+    nb.save(nb.gifti.GiftiImage(darrays=darrays), data_file)
+
+    dense = compute_similarity.compute_similarity(data_file, type, dense=False)
+    r = compute_similarity.compute_similarity(data_file, type, pairs=pairs)
+
+    assert_same_pairs(r, pairs, dense)
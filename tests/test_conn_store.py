@@ -0,0 +1,59 @@
+'''
+Unit tests for conn_store
+'''
+
+import numpy as np
+import pytest
+
+import sparque.conn_store as conn_store
+import sparque.reliability as reliability
+
+
+def test_conn_store(tmp_path, monkeypatch):
+    N_SUBJECTS = 3
+    N_SESSIONS = 2
+    N_EDGES = 45
+
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+    subjects = np.repeat([f'sub-{i}' for i in range(N_SUBJECTS)], N_SESSIONS)
+    sessions = np.tile([f'ses-{i}' for i in range(N_SESSIONS)], N_SUBJECTS)
+    edges = np.tanh(rng.standard_normal((len(subjects), N_EDGES))).astype(np.float32)
+
+    conn_store.write_conn_store('conn', subjects[:2], sessions[:2], edges[:2])
+    conn_store.write_conn_store('conn', subjects[2:], sessions[2:], edges[2:],
+                                append = True)
+
+    metadata, stored_edges = conn_store.load_conn_store('conn')
+    assert isinstance(stored_edges, np.memmap)
+    assert np.array_equal(stored_edges, edges)
+    assert list(metadata['subject']) == list(subjects)
+    assert list(metadata['label']) == list(subjects)
+
+    conn_df = conn_store.conn_store_to_df('conn')
+    store_df = reliability.reliability_multiple_subjects('conn', 'subject', 'store.h5')
+    csv_df = reliability.reliability_multiple_subjects(conn_df.drop(columns = 'label'),
+                                                       'subject', 'csv.h5', 2)
+
+    assert list(store_df['subject']) == list(csv_df['subject'])
+    for from_store, from_csv in zip(store_df['reliabilities'], csv_df['reliabilities']):
+        assert np.allclose(from_store, from_csv)
+
+def test_interrupted_append(tmp_path):
+    N_EDGES = 10
+
+    rng = np.random.default_rng(1)
+    edges = rng.standard_normal((4, N_EDGES)).astype(np.float32)
+    conn_store.write_conn_store(tmp_path / 'conn', ['a', 'a'], [0, 1], edges[:2])
+
+    # an append interrupted after writing part of its edges, before its metadata
+    with open(tmp_path / 'conn' / conn_store.EDGES_FILE, 'ab') as f:
+        edges[2, :7].tofile(f)
+    with pytest.raises(ValueError):
+        conn_store.load_conn_store(tmp_path / 'conn')
+
+    conn_store.write_conn_store(tmp_path / 'conn', ['b', 'b'], [0, 1], edges[2:],
+                                append = True)
+    metadata, stored_edges = conn_store.load_conn_store(tmp_path / 'conn')
+    assert list(metadata['subject']) == ['a', 'a', 'b', 'b']
+    assert np.array_equal(stored_edges, edges)
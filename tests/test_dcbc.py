@@ -0,0 +1,95 @@
+'''
+Unit tests for DCBC
+'''
+
+import os
+
+import nibabel as nb
+import numpy as np
+import scipy.io as spio
+import scipy.sparse
+
+from sparque.DCBC import eval_DCBC
+
+N_VERTICES = 300
+N_CONDITIONS = 10
+N_SUBJECTS = 2
+
+def make_dcbc_dir(path, seed=0):
+    rng = np.random.default_rng(seed)
+
+    coordinates = rng.random((N_VERTICES, 3)) * 40
+    diff = coordinates[:, np.newaxis] - coordinates[np.newaxis]
+    dist = np.sqrt(np.sum(np.square(diff), axis=-1))
+    dist[dist > 40] = 0
+    spio.savemat(os.path.join(path, 'dist.mat'),
+                 {'avrgDs': scipy.sparse.csc_matrix(dist)})
+
+    for subj in range(N_SUBJECTS):
+        subj_dir = os.path.join(path, 'data', f's0{subj}')
+        os.makedirs(subj_dir)
+        data = rng.standard_normal((N_VERTICES, N_CONDITIONS)).astype(np.float32)
+        if subj == 1:
+            data[:5] = np.nan
+        darrays = [nb.gifti.GiftiDataArray(data[:, k]) for k in range(N_CONDITIONS)]
+        gii = nb.gifti.GiftiImage(darrays=darrays)
+        nb.save(gii, os.path.join(subj_dir, f's0{subj}.L.wbeta.32k.func.gii'))
+
+    parcellations = [rng.integers(0, 10, N_VERTICES), rng.integers(1, 25, N_VERTICES)]
+    return os.path.join(path, 'dist.mat'), parcellations
+
+def assert_same_dcbc(T1, T2):
+    assert sorted(T1) == sorted(T2)
+    for key in T1:
+        for field in ['num_within', 'num_between', 'corr_within', 'corr_between',
+                      'weight', 'DCBC']:
+            assert np.allclose(T1[key][field], T2[key][field], equal_nan=True,
+                               rtol=1e-4, atol=1e-6)
+
+def test_sparse_matches_dense(tmp_path, monkeypatch):
+    dist_file, parcellations = make_dcbc_dir(tmp_path)
+    monkeypatch.chdir(tmp_path)
+
+    dense = eval_DCBC.DCBC(hems='L', maxDist=35, binWidth=2.5, dist_file=dist_file,
+                           sparse=False).evaluate(parcellations[0])
+    sparse = eval_DCBC.DCBC(hems='L', maxDist=35, binWidth=2.5,
+                            dist_file=dist_file).evaluate(parcellations[0])
+
+    assert_same_dcbc(dense, sparse)
+
+def test_evaluate_many_matches_evaluate(tmp_path, monkeypatch):
+    dist_file, parcellations = make_dcbc_dir(tmp_path)
+    monkeypatch.chdir(tmp_path)
+
+    myDCBC = eval_DCBC.DCBC(hems='L', maxDist=35, binWidth=2.5, dist_file=dist_file)
+    all_T = myDCBC.evaluate_many(parcellations)
+
+    for parcellation, T in zip(parcellations, all_T):
+        assert_same_dcbc(myDCBC.evaluate(parcellation), T)
+
+def test_parallel_matches_serial(tmp_path, monkeypatch):
+    dist_file, parcellations = make_dcbc_dir(tmp_path)
+    monkeypatch.chdir(tmp_path)
+
+    myDCBC = eval_DCBC.DCBC(hems='L', maxDist=35, binWidth=2.5, dist_file=dist_file)
+
+    assert_same_dcbc(myDCBC.evaluate(parcellations[0]),
+                     myDCBC.evaluate(parcellations[0], n_jobs=2))
+
+def test_subject_pairs_cached_by_nan_pattern(tmp_path, monkeypatch):
+    dist_file, parcellations = make_dcbc_dir(tmp_path)
+    monkeypatch.chdir(tmp_path)
+
+    calls = []
+    filter_pairs = eval_DCBC.filter_pairs
+    monkeypatch.setattr(eval_DCBC, 'filter_pairs',
+                        lambda *args: calls.append(args[-1].sum()) or filter_pairs(*args))
+
+    myDCBC = eval_DCBC.DCBC(hems='L', maxDist=35, binWidth=2.5, dist_file=dist_file)
+    T = myDCBC.evaluate(parcellations[0])
+    # the medial wall once, then the nan vertices of subject 1
+    assert calls == [(parcellations[0] == 0).sum(), 5]
+
+    # the second pass filters only the medial wall again
+    assert_same_dcbc(T, myDCBC.evaluate(parcellations[0]))
+    assert len(calls) == 3
@@ -0,0 +1,132 @@
+'''
+Unit tests for functional connectivity homogeneity
+'''
+
+import os
+
+import nibabel as nb
+import numpy as np
+import pandas as pd
+
+import sparque.fc_homogeneity as fc_homogeneity
+import sparque.utils as utils
+
+
+def test_fc_homogeneity_matches_corrcoef():
+    N_VOXELS = 200
+    N_TIMEPOINTS = 50
+
+    rng = np.random.default_rng(0)
+    atlas_fdata = rng.integers(1, 6, N_VOXELS)
+    fdata = (rng.standard_normal((N_VOXELS, N_TIMEPOINTS))
+             + atlas_fdata[:, np.newaxis] * rng.standard_normal(N_TIMEPOINTS))
+
+    avg_fch, all_fch = fc_homogeneity.calc_fc_homogeneity(atlas_fdata, fdata)
+
+    expected_fch = [np.mean(np.corrcoef(fdata[atlas_fdata == parcel]))
+                    for parcel in np.unique(atlas_fdata)]
+
+    assert np.allclose(all_fch, expected_fch)
+    assert np.isclose(avg_fch, np.mean(expected_fch))
+
+def test_fc_homogeneity_single_voxel_parcel():
+    rng = np.random.default_rng(1)
+    parcel_data = rng.standard_normal((1, 30))
+
+    assert np.isclose(fc_homogeneity.parcel_fc_homogeneity(parcel_data), 1.0)
+
+def test_fc_homogeneity_filtered_index():
+    N_VOXELS = 120
+    N_TIMEPOINTS = 40
+
+    rng = np.random.default_rng(2)
+    atlas_fdata = rng.integers(0, 5, N_VOXELS)
+    fdata = rng.standard_normal((N_VOXELS, N_TIMEPOINTS))
+    keep = rng.random(N_VOXELS) > 0.3
+    keep[atlas_fdata == 4] = False
+
+    parcel_index = utils.filter_parcel_index(utils.build_parcel_index(atlas_fdata), keep)
+    avg_fch, all_fch = fc_homogeneity.fc_homogeneity_from_index(
+        parcel_index, fc_homogeneity.zscore_ts(fdata[keep]))
+
+    expected_avg_fch, expected_all_fch = fc_homogeneity.calc_fc_homogeneity(
+        atlas_fdata[keep], fdata[keep])
+
+    assert list(parcel_index[0]) == [1, 2, 3]
+    assert np.allclose(all_fch, expected_all_fch)
+    assert np.isclose(avg_fch, expected_avg_fch)
+
+def test_parallel_fc_homogeneity(tmp_path):
+    N_TIMEPOINTS = 30
+
+    rng = np.random.default_rng(3)
+    affine = np.diag([3., 3., 3., 1.])
+    parc_fdatas = [rng.integers(0, 6, (6, 6, 5)), rng.integers(0, 3, (6, 6, 5))]
+    scans = []
+    for i in range(4):
+        scan = str(tmp_path / f'sub-{i:02d}_ses-01_task-rest_run-1_bold.nii.gz')
+        scan_fdata = rng.standard_normal((6, 6, 5, N_TIMEPOINTS)).astype(np.float32)
+        nb.Nifti1Image(scan_fdata, affine).to_filename(scan)
+        scans += [scan]
+
+    serial_files = [str(tmp_path / 'serial_a.csv'), str(tmp_path / 'serial_b.csv')]
+    parallel_files = [str(tmp_path / 'parallel_a.csv'), str(tmp_path / 'parallel_b.csv')]
+    serial_dfs = fc_homogeneity.run_fc_homogeneity_many(scans, ['a', 'b'], parc_fdatas,
+                                                        serial_files, surface=False)
+    parallel_dfs = fc_homogeneity.run_fc_homogeneity_many(scans, ['a', 'b'], parc_fdatas,
+                                                          parallel_files, surface=False,
+                                                          n_jobs=2)
+
+    for serial_df, parallel_df in zip(serial_dfs, parallel_dfs):
+        pd.testing.assert_frame_equal(serial_df, parallel_df)
+    assert not np.allclose(serial_dfs[0]['fchs'], serial_dfs[0]['fchs'][0])
+
+def test_fc_homogeneity_cache(tmp_path, monkeypatch):
+    N_TIMEPOINTS = 30
+
+    rng = np.random.default_rng(4)
+    affine = np.diag([3., 3., 3., 1.])
+    parc_fdatas = [rng.integers(0, 6, (6, 6, 5)), rng.integers(0, 3, (6, 6, 5))]
+    scans = []
+    for i in range(2):
+        scan = str(tmp_path / f'sub-{i:02d}_ses-01_task-rest_run-1_bold.nii.gz')
+        scan_fdata = rng.standard_normal((6, 6, 5, N_TIMEPOINTS)).astype(np.float32)
+        # voxels outside the brain are dropped by the standard deviation filter
+        scan_fdata[:2] = 0
+        nb.Nifti1Image(scan_fdata, affine).to_filename(scan)
+        scans += [scan]
+    cache_dir = str(tmp_path / 'cache')
+
+    def run(name, parc_indices, **kwargs):
+        return fc_homogeneity.run_fc_homogeneity_many(
+            scans, [f'{name}_{i}' for i in parc_indices],
+            [parc_fdatas[i] for i in parc_indices],
+            [str(tmp_path / f'{name}_{i}.csv') for i in parc_indices], surface=False,
+            **kwargs)
+
+    uncached_dfs = run('uncached', [0, 1])
+    run('both', [0, 1], cache_dir=cache_dir)
+    # other parcellations reuse the entries of the same scans
+    monkeypatch.setattr(utils, 'load_masked_data', None)
+    second_df, = run('second', [1], cache_dir=cache_dir)
+
+    assert len([name for name in os.listdir(cache_dir) if name.endswith('.npy')]) == 4
+    pd.testing.assert_series_equal(second_df['fchs'], uncached_dfs[1]['fchs'])
+    assert list(second_df['all_fchs']) == list(uncached_dfs[1]['all_fchs'])
+
+def test_fc_homogeneity_float32_accumulation():
+    N_VOXELS = 5000
+    N_TIMEPOINTS = 40
+
+    rng = np.random.default_rng(5)
+    atlas_fdata = rng.integers(1, 3, N_VOXELS)
+    fdata = (rng.standard_normal((N_VOXELS, N_TIMEPOINTS))
+             + 0.3 * rng.standard_normal(N_TIMEPOINTS))
+    parcel_index = utils.build_parcel_index(atlas_fdata)
+
+    # float32 time series are summed in float64, so only their own rounding is left
+    _, all_fch = fc_homogeneity.fc_homogeneity_from_index(
+        parcel_index, fc_homogeneity.zscore_ts(fdata).astype(np.float32))
+    _, expected_fch = fc_homogeneity.calc_fc_homogeneity(atlas_fdata, fdata)
+
+    assert np.allclose(all_fch, expected_fch, rtol=1e-8, atol=0)
@@ -0,0 +1,206 @@
+'''
+Unit tests for func_conn
+'''
+
+import os
+
+import nibabel as nb
+import numpy as np
+import pandas as pd
+from nilearn.maskers import NiftiLabelsMasker
+
+import sparque.func_conn as func_conn
+import sparque.ts_store as ts_store
+
+
+def make_func_conn_dir(tmp_path, n_subjects = 2, n_sessions = 2, n_timepoints = 40):
+    rng = np.random.default_rng(0)
+    affine = np.diag([3., 3., 3., 1.])
+
+    atlas = rng.integers(0, 6, size = (6, 6, 5)).astype(np.int16)
+    parcellation_file = str(tmp_path / 'atlas.nii.gz')
+    nb.Nifti1Image(atlas, affine).to_filename(parcellation_file)
+
+    scans = []
+    for subj in range(n_subjects):
+        for ses in range(n_sessions):
+            scan_name = f'sub-{subj:02d}_ses-{ses:02d}_task-rest_run-1_bold.nii.gz'
+            scan = str(tmp_path / scan_name)
+            fdata = rng.standard_normal(atlas.shape + (n_timepoints,)).astype(np.float32)
+            nb.Nifti1Image(fdata, affine).to_filename(scan)
+            scans += [scan]
+
+    return parcellation_file, scans
+
+def test_conn_from_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parcellation_file, scans = make_func_conn_dir(tmp_path)
+
+    conn_df = func_conn.conn_from_dir('test_parcellation', parcellation_file, scans)
+
+    assert list(conn_df['subject']) == ['sub-00', 'sub-00', 'sub-01', 'sub-01']
+    assert list(conn_df['session']) == ['ses-00', 'ses-01', 'ses-00', 'ses-01']
+    assert list(conn_df['label']) == list(conn_df['subject'])
+
+    for i, scan in enumerate(scans):
+        masker = NiftiLabelsMasker(labels_img = parcellation_file, standardize = True)
+        time_series = masker.fit_transform(scan)
+        conn_mat = np.corrcoef(time_series.T)
+        edges = conn_df.iloc[i, 2:-1].to_numpy(dtype = np.float32)
+        assert np.allclose(edges, func_conn.get_uniq_conn_vals(conn_mat), atol = 1e-6)
+
+    time_series_df = ts_store.load_time_series_df('test_parcellation_time_series.h5')
+    assert list(time_series_df['subject']) == list(conn_df['subject'])
+
+    index = ts_store.load_time_series_index('test_parcellation_time_series.h5')
+    assert list(index['session']) == list(conn_df['session'])
+    time_series = ts_store.load_time_series('test_parcellation_time_series.h5',
+                                            index['key'].iloc[2])
+    assert np.array_equal(time_series, time_series_df['time_series'].iloc[2])
+    masker = NiftiLabelsMasker(labels_img = parcellation_file, standardize = True)
+    assert np.allclose(time_series, masker.fit_transform(scans[2]), atol = 1e-5)
+
+def test_parallel_conn_from_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parcellation_file, scans = make_func_conn_dir(tmp_path, n_subjects = 3)
+
+    serial_df = func_conn.conn_from_dir('serial', parcellation_file, scans)
+    parallel_df = func_conn.conn_from_dir('parallel', parcellation_file, scans,
+                                          n_jobs = 2,
+                                          max_worker_memory = 8 * 1024 ** 3)
+
+    pd.testing.assert_frame_equal(serial_df, parallel_df)
+
+    serial_ts = ts_store.load_time_series_df('serial_time_series.h5')
+    parallel_ts = ts_store.load_time_series_df('parallel_time_series.h5')
+    for serial, parallel in zip(serial_ts['time_series'], parallel_ts['time_series']):
+        assert np.array_equal(serial, parallel)
+
+def test_label_extractor(tmp_path):
+    parcellation_file, scans = make_func_conn_dir(tmp_path)
+
+    # parcellation on a finer grid than the scans, so it has to be resampled
+    rng = np.random.default_rng(1)
+    fine_parcellation_file = str(tmp_path / 'fine_atlas.nii.gz')
+    fine_atlas = rng.integers(0, 8, size = (12, 12, 10)).astype(np.int16)
+    fine_affine = np.diag([1.5, 1.5, 1.5, 1.])
+    nb.Nifti1Image(fine_atlas, fine_affine).to_filename(fine_parcellation_file)
+
+    confounds = rng.standard_normal((40, 3))
+
+    for curr_parcellation_file in [parcellation_file, fine_parcellation_file]:
+        extractor = func_conn.LabelExtractor.from_scan(
+            curr_parcellation_file, scans[0], cache_dir = str(tmp_path / 'cache'))
+        cached_extractor = func_conn.LabelExtractor.from_scan(
+            curr_parcellation_file, scans[0], cache_dir = str(tmp_path / 'cache'))
+        assert np.array_equal(extractor.parcels, cached_extractor.parcels)
+
+        for scan in scans:
+            masker = NiftiLabelsMasker(labels_img = curr_parcellation_file,
+                                       standardize = True)
+            assert np.allclose(extractor.transform(scan), masker.fit_transform(scan),
+                               atol = 1e-5)
+            assert np.allclose(extractor.transform(scan, confounds),
+                               masker.fit_transform(scan, confounds = confounds),
+                               atol = 1e-5)
+
+def test_connectivity_surface(tmp_path):
+    N_VERTICES = 200
+    N_TIMEPOINTS = 30
+    rng = np.random.default_rng(2)
+
+    parcellation_files, scan, all_labels, all_data = [], [], [], []
+    for hemi in ['L', 'R']:
+        # label 6 is the medial wall, and label 3 is left out of the right hemisphere
+        labels = rng.integers(0, 7, size = N_VERTICES).astype(np.int32)
+        if hemi == 'R':
+            labels[labels == 3] = 0
+        parcellation_file = str(tmp_path / f'atlas.{hemi}.label.gii')
+        nb.save(nb.gifti.GiftiImage(darrays = [nb.gifti.GiftiDataArray(labels)]),
+                parcellation_file)
+
+        data = rng.standard_normal((N_VERTICES, N_TIMEPOINTS)).astype(np.float32)
+        scan_file = str(tmp_path / f'sub-01_ses-01_{hemi}.func.gii')
+        darrays = [nb.gifti.GiftiDataArray(data[:, t]) for t in range(N_TIMEPOINTS)]
+        nb.save(nb.gifti.GiftiImage(darrays = darrays), scan_file)
+
+        parcellation_files += [parcellation_file]
+        scan += [scan_file]
+        all_labels += [labels]
+        all_data += [data]
+
+    time_series, conn_mat = func_conn.run_connectivity_surface(tuple(parcellation_files),
+                                                               tuple(scan))
+
+    expected = np.vstack([[data[labels == label].mean(axis = 0)
+                           for label in np.unique(labels[(labels != 0) & (labels != 6)])]
+                          for labels, data in zip(all_labels, all_data)])
+    assert time_series.shape == (5 + 4, N_TIMEPOINTS)
+    assert np.allclose(time_series, expected, atol = 1e-6)
+    assert np.allclose(conn_mat, np.corrcoef(expected), atol = 1e-5)
+
+def test_conn_from_dir_many(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parcellation_file, scans = make_func_conn_dir(tmp_path)
+
+    rng = np.random.default_rng(3)
+    other_parcellation_file = str(tmp_path / 'other_atlas.nii.gz')
+    other_atlas = rng.integers(0, 4, size = (6, 6, 5)).astype(np.int16)
+    affine = np.diag([3., 3., 3., 1.])
+    nb.Nifti1Image(other_atlas, affine).to_filename(other_parcellation_file)
+
+    parcellation_files = [parcellation_file, other_parcellation_file]
+    all_conn_df = func_conn.conn_from_dir_many(['first', 'other'], parcellation_files,
+                                               scans)
+
+    first_df = func_conn.conn_from_dir('first_single', parcellation_file, scans)
+    other_df = func_conn.conn_from_dir('other_single', other_parcellation_file, scans)
+    pd.testing.assert_frame_equal(all_conn_df[0], first_df, atol = 1e-6)
+    pd.testing.assert_frame_equal(all_conn_df[1], other_df, atol = 1e-6)
+
+    for parc_name in ['first', 'other']:
+        time_series_df = ts_store.load_time_series_df(f'{parc_name}_time_series.h5')
+        single_time_series_df = ts_store.load_time_series_df(
+            f'{parc_name}_single_time_series.h5')
+        for time_series, single_time_series in zip(time_series_df['time_series'],
+                                                   single_time_series_df['time_series']):
+            assert np.allclose(time_series, single_time_series)
+
+def test_conn_from_dir_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parcellation_file, scans = make_func_conn_dir(tmp_path, n_subjects = 1)
+    cache_dir = str(tmp_path / 'cache')
+
+    # voxels outside the brain are left out of the cache
+    scan = nb.load(scans[0])
+    fdata = scan.get_fdata(dtype = np.float32)
+    fdata[:2] = 0
+    nb.Nifti1Image(fdata, scan.affine).to_filename(scans[0])
+
+    rng = np.random.default_rng(4)
+    other_parcellation_file = str(tmp_path / 'other_atlas.nii.gz')
+    other_atlas = rng.integers(0, 4, size = (6, 6, 5)).astype(np.int16)
+    nb.Nifti1Image(other_atlas, scan.affine).to_filename(other_parcellation_file)
+
+    conn_df = func_conn.conn_from_dir('uncached', parcellation_file, scans)
+    other_conn_df = func_conn.conn_from_dir('other_uncached', other_parcellation_file,
+                                            scans)
+    cached_df = func_conn.conn_from_dir('cached', parcellation_file, scans,
+                                        cache_dir = cache_dir)
+    # a fresh process only finds the cached parcellation and in-brain voxels on disk
+    func_conn._label_extractors.clear()
+    func_conn._stacked_label_extractors.clear()
+    monkeypatch.setattr(func_conn.utils, 'load_masked_data', None)
+    rerun_df = func_conn.conn_from_dir('rerun', parcellation_file, scans,
+                                       cache_dir = cache_dir)
+    # the in-brain voxels do not depend on the parcellations
+    all_conn_df = func_conn.conn_from_dir_many(
+        ['first', 'other'], [parcellation_file, other_parcellation_file], scans,
+        cache_dir = cache_dir)
+
+    cached_files = [name for name in os.listdir(cache_dir) if name.endswith('.npy')]
+    assert len(cached_files) == 2 + 2 * len(scans)
+    pd.testing.assert_frame_equal(cached_df, conn_df)
+    pd.testing.assert_frame_equal(rerun_df, conn_df)
+    pd.testing.assert_frame_equal(all_conn_df[0], conn_df, atol = 1e-6)
+    pd.testing.assert_frame_equal(all_conn_df[1], other_conn_df, atol = 1e-6)
@@ -4,7 +4,10 @@ Unit tests for reliability
 
 import numpy as np
 import pandas as pd
-import sparque.sparque as sparque 
+
+import sparque.reliability as reliability
+import sparque.sparque as sparque
+
 
 def test_reliability():
     N_SUBJECTS = 2
@@ -66,3 +69,82 @@ def test_reliability():
     assert sub_all['reliability'].iloc[0] == np.mean([sub1['reliability'].iloc[0],sub2['reliability'].iloc[0]])
 
     assert sub1['reliability'].iloc[0] > sub2['reliability'].iloc[0]
+
+def test_vectorized_reliability():
+    N_SUBJECTS = 4
+    N_SESSIONS = 3
+    N_EDGES = 45
+
+    rng = np.random.default_rng(0)
+    subjects = np.repeat(np.arange(N_SUBJECTS), N_SESSIONS)
+    rng.shuffle(subjects)
+    noise = 0.5 * rng.standard_normal((len(subjects), N_EDGES))
+    edges = np.tanh(rng.standard_normal((N_SUBJECTS, N_EDGES))[subjects] + noise)
+
+    test_df = pd.DataFrame(edges)
+    test_df.insert(0, 'session', 0)
+    test_df.insert(0, 'subject', subjects)
+
+    unique_subjects, all_reliabilities = reliability.reliability_from_edges(subjects,
+                                                                            edges)
+
+    assert list(unique_subjects) == list(range(N_SUBJECTS))
+    for subj, reliabilities in zip(unique_subjects, all_reliabilities):
+        expected = reliability.calc_reliability(subj, test_df, 'subject', 2)
+        assert np.allclose(reliabilities, expected, atol=1e-5)
+
+def test_incremental_reliability(tmp_path, monkeypatch):
+    N_SUBJECTS = 3
+    N_EDGES = 45
+
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(1)
+    subjects = np.array([0, 0, 1, 1, 2, 0, 1, 1, 2])
+    noise = 0.5 * rng.standard_normal((len(subjects), N_EDGES))
+    edges = np.tanh(rng.standard_normal((N_SUBJECTS, N_EDGES))[subjects] + noise)
+
+    test_df = pd.DataFrame(edges)
+    test_df.insert(0, 'session', np.arange(len(subjects)))
+    test_df.insert(0, 'subject', subjects)
+
+    # first batch leaves subject 2 with a single session
+    reliability.reliability_multiple_subjects(test_df.iloc[:5], 'subject',
+                                              'incremental.h5', 2, incremental = True)
+    updated_df = reliability.reliability_multiple_subjects(test_df.iloc[5:], 'subject',
+                                                           'incremental.h5', 2,
+                                                           incremental = True)
+    full_df = reliability.reliability_multiple_subjects(test_df, 'subject', 'full.h5', 2)
+
+    assert list(updated_df['subject']) == list(full_df['subject'])
+    for updated, full in zip(updated_df['reliabilities'], full_df['reliabilities']):
+        assert np.allclose(updated, full, atol=1e-6)
+
+def test_incremental_reliability_repeated_sessions(tmp_path, monkeypatch):
+    N_SUBJECTS = 2
+    N_EDGES = 45
+
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(2)
+    subjects = np.array([0, 0, 0, 1, 1])
+    noise = 0.5 * rng.standard_normal((len(subjects), N_EDGES))
+    edges = np.tanh(rng.standard_normal((N_SUBJECTS, N_EDGES))[subjects] + noise)
+
+    test_df = pd.DataFrame(edges)
+    test_df.insert(0, 'session', np.arange(len(subjects)))
+    test_df.insert(0, 'subject', subjects)
+
+    first_df = reliability.update_reliability(test_df, 'subject', 'incremental.h5', 2)
+
+    # sessions passed again are not added twice
+    repeated_df = reliability.update_reliability(test_df.iloc[[1, 3]], 'subject',
+                                                 'incremental.h5', 2)
+    for first, repeated in zip(first_df['reliabilities'], repeated_df['reliabilities']):
+        assert np.allclose(first, repeated, atol=1e-6)
+
+    # sessions passed with new edges replace the stored ones
+    test_df.iloc[1, 2:] = np.tanh(rng.standard_normal(N_EDGES))
+    replaced_df = reliability.update_reliability(test_df.iloc[[1]], 'subject',
+                                                 'incremental.h5', 2)
+    full_df = reliability.reliability_multiple_subjects(test_df, 'subject', 'full.h5', 2)
+    for replaced, full in zip(replaced_df['reliabilities'], full_df['reliabilities']):
+        assert np.allclose(replaced, full, atol=1e-6)
@@ -0,0 +1,95 @@
+'''
+Unit tests for svc
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import sparque.conn_store as conn_store
+import sparque.svc as svc
+import sparque.utils as utils
+
+
+def make_conn_df(n_subjects = 4, n_sessions = 6, n_edges = 20):
+    rng = np.random.default_rng(0)
+    subjects = np.repeat([f'sub-{i}' for i in range(n_subjects)], n_sessions)
+    subject_edges = rng.standard_normal((n_subjects, n_edges))
+    edges = (subject_edges[np.repeat(np.arange(n_subjects), n_sessions)]
+             + rng.standard_normal((len(subjects), n_edges)))
+
+    # same layout as a `.csv` saved by `func_conn.conn_from_dir`: index, subject, session,
+    # edges, label
+    conn_df = pd.DataFrame(edges)
+    conn_df.insert(0, 'session', np.tile(np.arange(n_sessions), n_subjects))
+    conn_df.insert(0, 'subject', subjects)
+    conn_df.insert(0, 'index', np.arange(len(subjects)))
+    conn_df['label'] = subjects
+    return conn_df
+
+def test_parallel_svc(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    conn_df = make_conn_df()
+
+    serial_df, serial_C_fold_scores = svc.run_svc_with_shuffle_split(conn_df.copy(),
+                                                                     n_splits = 4)
+    parallel_df, parallel_C_fold_scores = svc.run_svc_with_shuffle_split(
+        conn_df.copy(), n_jobs = 2, n_splits = 4)
+    folds_df, folds_C_fold_scores = svc.run_svc_with_shuffle_split(
+        conn_df.copy(), n_jobs = 2, parallel_folds = True, n_splits = 4)
+
+    assert serial_df['accuracy'].mean() > 0.5
+    pd.testing.assert_frame_equal(serial_df, parallel_df)
+    pd.testing.assert_frame_equal(serial_df, folds_df)
+    assert serial_C_fold_scores == parallel_C_fold_scores == folds_C_fold_scores
+
+def test_parallel_svc_conn_store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store_dir = conn_store.conn_df_to_store(make_conn_df(), str(tmp_path / 'store'),
+                                            func_conn_col_start = 3)
+
+    serial_df, serial_C_fold_scores = svc.run_svc_with_shuffle_split(store_dir,
+                                                                     n_splits = 4)
+    # workers map the edges file of the store instead of a copy of X
+    monkeypatch.setattr(utils, 'save_shared_array', None)
+    parallel_df, parallel_C_fold_scores = svc.run_svc_with_shuffle_split(
+        store_dir, n_jobs = 2, n_splits = 4)
+    folds_df, folds_C_fold_scores = svc.run_svc_with_shuffle_split(
+        store_dir, n_jobs = 2, parallel_folds = True, n_splits = 4)
+
+    assert serial_df['accuracy'].mean() > 0.5
+    pd.testing.assert_frame_equal(serial_df, parallel_df)
+    pd.testing.assert_frame_equal(serial_df, folds_df)
+    assert serial_C_fold_scores == parallel_C_fold_scores == folds_C_fold_scores
+
+def test_successive_halving(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    conn_df = make_conn_df()
+
+    grid_df, _ = svc.run_svc_with_shuffle_split(conn_df.copy(), n_splits = 4)
+    halving_df, C_fold_scores = svc.run_svc_with_shuffle_split(conn_df.copy(),
+                                                               n_splits = 4,
+                                                               search = 'halving')
+
+    assert list(grid_df['n_fits']) == [len(svc.C_GRID) * svc.N_FOLDS + 1] * 4
+    assert list(halving_df['n_fits']) == [9 * 1 + 3 * 2 + 1] * 4
+    assert set(halving_df['C']) <= set(svc.C_GRID)
+    assert halving_df['accuracy'].mean() > 0.5
+
+    # the chosen C was scored on the most folds
+    C_fold_scores = pd.DataFrame.from_dict(C_fold_scores)
+    n_chosen_folds = (C_fold_scores['C'] == halving_df['C'].iloc[-1]).sum()
+    assert n_chosen_folds == C_fold_scores.groupby('C').size().max()
+
+def test_successive_halving_eta(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    conn_df = make_conn_df()
+    X = conn_df.iloc[:, 3:-1].to_numpy()
+    y = conn_df['label'].to_numpy()
+
+    for eta in [0, 1, 1.5]:
+        with pytest.raises(ValueError):
+            svc.svc_successive_halving(X, y, np.arange(len(y)), eta = eta)
+        with pytest.raises(ValueError):
+            svc.run_svc_with_shuffle_split(conn_df.copy(), n_splits = 1,
+                                           search = 'halving', eta = eta)
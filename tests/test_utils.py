@@ -0,0 +1,42 @@
+'''
+Unit tests for utils
+'''
+
+import os
+
+import nibabel as nb
+import numpy as np
+import pytest
+
+import sparque.utils as utils
+
+
+def test_get_n_jobs(monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+
+    assert utils.get_n_jobs(1) == 1
+    assert utils.get_n_jobs(3) == 3
+    assert utils.get_n_jobs(-1) == 8
+    assert utils.get_n_jobs(-2) == 7
+    assert utils.get_n_jobs(-8) == 1
+    for n_jobs in [0, -9]:
+        with pytest.raises(ValueError):
+            utils.get_n_jobs(n_jobs)
+
+@pytest.mark.parametrize('extension', ['.nii', '.nii.gz'])
+def test_load_masked_data(tmp_path, extension):
+    rng = np.random.default_rng(0)
+    scan = str(tmp_path / f'scan{extension}')
+    scan_fdata = rng.standard_normal((5, 4, 3, 23)).astype(np.float32)
+    nb.Nifti1Image(scan_fdata, np.eye(4)).to_filename(scan)
+    mask = rng.random((5, 4, 3)) > 0.4
+
+    # chunks of 10 time points leave a partial last chunk
+    loaded_data, fdata = utils.load_masked_data(scan, mask.ravel(), chunk_size = 10)
+    _, all_fdata = utils.load_masked_data(scan)
+
+    expected_fdata = nb.load(scan).get_fdata()
+    assert loaded_data.shape == (5, 4, 3, 23)
+    assert fdata.dtype == np.float32
+    assert np.array_equal(fdata, expected_fdata[mask])
+    assert np.array_equal(all_fdata, expected_fdata.reshape(-1, 23))